@@ -254,6 +254,8 @@ class Answerfile:
                 address = "Install disc"
             elif rtype in ['url', 'nfs']:
                 address = getText(i)
+            elif rtype == 'mirrors':
+                address = [self.parseMirror(m) for m in getElementsByTagName(i, ['mirror'], mandatory=True)]
             else:
                 raise AnswerfileException("Invalid type for <source> media specified.")
             if rtype == 'url' and address.startswith('nfs://'):
@@ -267,6 +269,18 @@ class Answerfile:
 
         return results
 
+    def parseMirror(self, node):
+        rtype = getStrAttribute(node, ['type'], mandatory=True)
+        address = getText(node)
+        if rtype not in ['url', 'nfs']:
+            raise AnswerfileException("Invalid type for <mirror> media specified.")
+        if rtype == 'url' and address.startswith('nfs://'):
+            rtype = 'nfs'
+            address = address[6:]
+        if rtype == 'url':
+            address = util.URL(address)
+        return (rtype, address)
+
     def parseDriverSource(self):
         results = {}
         for source in getElementsByTagName(self.top_node, ['driver-source']):
@@ -7,12 +7,19 @@ import subprocess
 import datetime
 import re
 import tempfile
+import time
+import json
+import hashlib
+import heapq
+import threading
+import concurrent.futures
 
 import repository
 import generalui
 import xelogging
 import util
 import diskutil
+import copyutil
 from disktools import *
 import fcoeutil
 import netutil
@@ -38,6 +45,9 @@ from functools import reduce
 
 MY_PRODUCT_BRAND = PRODUCT_BRAND or PLATFORM_NAME
 
+# Maximum number of parallel Tasks executing at once
+MAX_PARALLEL_TASKS = 4
+
 class InvalidInstallerConfiguration(Exception):
     pass
 
@@ -52,11 +62,23 @@ class Task:
     'returns' is a list of the labels of the return values, or a function
            that, when given the 'args' labels list, returns the list of the
            labels of the return values.
+    'parallel' marks a task that may run concurrently with other parallel
+           tasks that do not share any of its labels or files.  Parallel
+           tasks are run off the UI thread and are not passed a progress
+           callback.
+    'files' lists the paths, relative to the target root, of every file the
+           task writes.  A parallel task without it is run as a barrier, so
+           only tasks that neither run commands in the target nor mount
+           anything may give it.
+    'resumable' is cleared for a task whose effects are confined to the
+           installer, or which uses answers left out of the checkpoint's
+           fingerprint, which must be executed again when an installation
+           is resumed.
     """
 
     def __init__(self, fn, args, returns, args_sensitive=False,
                  progress_scale=1, pass_progress_callback=False,
-                 progress_text=None):
+                 progress_text=None, parallel=False, resumable=True, files=None):
         self.fn = fn
         self.args = args
         self.returns = returns
@@ -64,6 +86,26 @@ class Task:
         self.progress_scale = progress_scale
         self.pass_progress_callback = pass_progress_callback
         self.progress_text = progress_text
+        self.parallel = parallel
+        self.resumable = resumable
+        self.files = files
+
+    def inputs(self):
+        """ Returns the labels read by the task, or None if they are not
+        known (i.e. args was not built using A or As). """
+        return getattr(self.args, 'labels', None)
+
+    def outputs(self):
+        """ Returns the labels and target files written by the task, or
+        None if they are only known once the task has been evaluated. """
+        if callable(self.returns) or self.files is None:
+            return None
+        return self.returns + self.files
+
+    def isBarrier(self):
+        """ A barrier task waits for all preceding tasks to complete and
+        all subsequent tasks wait for it. """
+        return not self.parallel or self.inputs() is None or self.outputs() is None
 
     def execute(self, answers, progress_callback=lambda x: ()):
         args = self.args(answers)
@@ -77,7 +119,18 @@ class Task:
         if self.pass_progress_callback:
             args.insert(0, progress_callback)
 
-        rv = self.fn(*args)
+        before = resourceUsage()
+        self.profile = {'task': getattr(self.fn, '__qualname__', str(self.fn)),
+                        'parallel': not self.isBarrier(),
+                        'status': 'failed'}
+        try:
+            rv = self.fn(*args)
+            self.profile['status'] = 'ok'
+        finally:
+            after = resourceUsage()
+            self.profile['start'] = before['wall']
+            for k in after:
+                self.profile[k] = after[k] - before[k]
         if type(rv) is not tuple:
             rv = (rv,)
         myrv = {}
@@ -91,6 +144,180 @@ class Task:
             myrv[ret[r]] = rv[r]
         return myrv
 
+def resourceUsage():
+    """ Returns the wall time, CPU time of the installer and of its reaped
+    child processes, and the bytes read from and written to storage so far.
+    The counters are process wide, so parallel tasks are charged for each
+    other's usage. """
+    t = os.times()
+    usage = {'wall': time.time(),
+             'cpu': t.user + t.system,
+             'children-cpu': t.children_user + t.children_system,
+             'read-bytes': 0,
+             'write-bytes': 0}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                k, v = line.split(':', 1)
+                if k == 'read_bytes':
+                    usage['read-bytes'] = int(v)
+                elif k == 'write_bytes':
+                    usage['write-bytes'] = int(v)
+    except (IOError, ValueError):
+        pass
+    return usage
+
+# Profile of every task executed, written out as constants.TIMELINE_FILE
+timeline = []
+timeline_lock = threading.Lock()
+
+def recordTimeline(seq_name, task):
+    profile = getattr(task, 'profile', None)
+    if profile is None:
+        return
+    profile = dict(profile, sequence=seq_name)
+    with timeline_lock:
+        timeline.append(profile)
+
+def writeTimeline():
+    with timeline_lock:
+        try:
+            with open(constants.TIMELINE_FILE, 'w') as f:
+                json.dump(sorted(timeline, key=lambda x: x['start']), f, indent=1)
+        except Exception as e:
+            logger.log("Failed to write task timeline: %s" % e)
+
+class Checkpoint:
+    """ Records the tasks of a fresh installation that have completed, and
+    the state they produced, in the logs partition of the target so that a
+    failed installation can be retried without repeating them.  Tasks are
+    identified by their position in the sequences executed, so a checkpoint
+    is only used by an installation with the same answers. """
+
+    def __init__(self, fingerprint, completed=None):
+        self.fingerprint = fingerprint
+        self.completed = completed or {}
+        self.phase = -1
+        self.discarded = False
+
+    def nextPhase(self):
+        self.phase += 1
+
+    def key(self, index, task):
+        return "%d:%d:%s" % (self.phase, index, getattr(task.fn, '__qualname__', str(task.fn)))
+
+    def restore(self, index, task):
+        """ Returns the state produced by the task in a previous attempt, or
+        None if it has to be executed. """
+        return self.completed.get(self.key(index, task))
+
+    def record(self, index, task, updated_state):
+        # Tasks producing state that cannot be saved (mounts, cleanup
+        # actions, repositories) are always executed again, as are those
+        # that only change the installer.
+        if not task.resumable:
+            return
+        try:
+            json.dumps(updated_state)
+        except (TypeError, ValueError):
+            return
+        self.completed[self.key(index, task)] = updated_state
+
+    def save(self, answers):
+        mounts = answers.get('mounts')
+        if self.discarded or not mounts or 'logs' not in mounts:
+            return
+        path = os.path.join(mounts['logs'], CHECKPOINT_FILE)
+        try:
+            with open(path + '.new', 'w') as f:
+                json.dump({'fingerprint': self.fingerprint,
+                           'primary-partnum': answers.get('primary-partnum'),
+                           'disk-label-suffix': answers.get('disk-label-suffix'),
+                           'completed': self.completed}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(path + '.new', path)
+        except Exception as e:
+            logger.log("Failed to write installation checkpoint: %s" % e)
+
+    def discard(self, mounts):
+        self.discarded = True
+        if 'logs' in mounts:
+            path = os.path.join(mounts['logs'], CHECKPOINT_FILE)
+            if os.path.exists(path):
+                os.unlink(path)
+
+def _fingerprintValue(value):
+    """ Serialises the answers which aren't plain data for the fingerprint:
+    objects describing themselves, such as the util.URL of an installation
+    source, by their string and others by their attributes. """
+    if type(value).__str__ is not object.__str__ or type(value).__repr__ is not object.__repr__:
+        return str(value)
+    return vars(value)
+
+def answersFingerprint(answers):
+    """ Digest of the answers, used to check that a checkpoint belongs to the
+    same installation. """
+    digest = hashlib.sha256()
+    for k in sorted(answers):
+        # skip the installer's own state, and the clock set by hand which
+        # only setTimeManually, executed on every attempt, depends on
+        if k in ('checkpoint', 'cleanup', 'ui', 'localtime', 'set-time-dialog-dismissed'):
+            continue
+        # the fingerprint is kept on disk: leave secrets out of it, the tasks
+        # using them are executed on every attempt
+        if k in ('root-password', 'pool-token'):
+            continue
+        try:
+            v = json.dumps(answers[k], sort_keys=True, default=_fingerprintValue)
+        except (TypeError, ValueError):
+            # not serialisable even so: its type at least must match
+            v = type(answers[k]).__name__
+        digest.update(("%s=%s\n" % (k, v)).encode())
+    return digest.hexdigest()
+
+def loadCheckpoint(answers):
+    """ Returns the checkpoint left in the logs partition of the primary disk
+    by a failed attempt at the same installation, or an empty checkpoint. """
+    checkpoint = Checkpoint(answersFingerprint(answers))
+    if not constants.RESUME_INSTALL:
+        return checkpoint
+
+    disk = answers['primary-disk']
+    try:
+        tool = PartitionTool(disk)
+        logs = [num for num, part in tool.items() if part.get('partlabel') == logspart_label]
+        if not logs:
+            return checkpoint
+        logs_fs = util.TempMount(partitionDevice(disk, logs[0]), 'checkpoint-', ['ro'])
+        try:
+            path = os.path.join(logs_fs.mount_point, CHECKPOINT_FILE)
+            if not os.path.exists(path):
+                return checkpoint
+            with open(path, 'r') as f:
+                data = json.load(f)
+        finally:
+            logs_fs.unmount()
+
+        if data['fingerprint'] != checkpoint.fingerprint:
+            logger.log("Not resuming installation: answers differ from the previous attempt")
+            return checkpoint
+        root = partitionDevice(disk, data['primary-partnum'])
+        rc, out = util.runCmd2(['blkid', '-o', 'value', '-s', 'LABEL', root], with_stdout=True)
+        if rc != 0 or out.strip() != rootfs_label % data['disk-label-suffix']:
+            logger.log("Not resuming installation: %s is not the root filesystem of the previous attempt" % root)
+            return checkpoint
+    except Exception as e:
+        logger.log("Not resuming installation: failed to read checkpoint: %s" % e)
+        return checkpoint
+
+    logger.log("Resuming installation: %d tasks completed by a previous attempt" % len(data['completed']))
+    return Checkpoint(checkpoint.fingerprint, data['completed'])
+
+def discardCheckpoint(checkpoint, mounts):
+    if checkpoint:
+        checkpoint.discard(mounts)
+
 ###
 # INSTALL SEQUENCES:
 # convenience functions
@@ -98,8 +325,17 @@ class Task:
 #    the labels when the function is called (late-binding)
 # As: As above but evaluated immediately (early-binding)
 # Use A when you require state values as well as the initial input values
-A = lambda ans, *params: ( lambda a: [a.get(param) for param in params] )
-As = lambda ans, *params: ( lambda _: [ans.get(param) for param in params] )
+# Both record the labels they depend on so that the dispatcher can work out
+# which tasks may run in parallel.
+def A(ans, *params):
+    fn = lambda a: [a.get(param) for param in params]
+    fn.labels = params
+    return fn
+
+def As(ans, *params):
+    fn = lambda _: [ans.get(param) for param in params]
+    fn.labels = ()
+    return fn
 
 def getPrepSequence(ans, interactive):
     seq = [
@@ -111,12 +347,12 @@ def getPrepSequence(ans, interactive):
         ]
 
     if ans['ntp-config-method'] in ("dhcp", "default", "manual"):
-        seq.append(Task(setTimeNTP, A(ans, 'ntp-servers', 'ntp-config-method'), []))
+        seq.append(Task(setTimeNTP, A(ans, 'ntp-servers', 'ntp-config-method'), [], resumable=False))
     elif ans['ntp-config-method'] == "none":
-        seq.append(Task(setTimeManually, A(ans, 'localtime', 'set-time-dialog-dismissed', 'timezone'), []))
+        seq.append(Task(setTimeManually, A(ans, 'localtime', 'set-time-dialog-dismissed', 'timezone'), [], resumable=False))
 
     if not interactive:
-        seq.append(Task(verifyRepos, A(ans, 'sources', 'ui'), []))
+        seq.append(Task(verifyRepos, A(ans, 'sources', 'ui'), [], resumable=False))
     if ans['install-type'] == INSTALL_TYPE_FRESH:
         seq += [
             Task(removeBlockingVGs, As(ans, 'guest-disks'), []),
@@ -173,11 +409,16 @@ def getRepoSequence(ans, repos):
     return seq
 
 def getFinalisationSequence(ans):
+    # Only tasks that write files of their own in the target, without running
+    # commands in it or mounting anything, are marked parallel; anything in a
+    # chroot is left serial.
     seq = [
         Task(scripts.run_scripts, lambda a: ['packages-installed',  a['mounts']['root']], []),
-        Task(writeResolvConf, A(ans, 'mounts', 'manual-hostname', 'manual-nameservers'), []),
+        Task(writeResolvConf, A(ans, 'mounts', 'manual-hostname', 'manual-nameservers'), [],
+             parallel=True, files=['etc/resolv.conf', 'etc/hostname']),
         Task(writeMachineID, A(ans, 'mounts'), []),
-        Task(writeKeyboardConfiguration, A(ans, 'mounts', 'keymap'), []),
+        Task(writeKeyboardConfiguration, A(ans, 'mounts', 'keymap'), [],
+             parallel=True, files=['etc/vconsole.conf']),
         Task(configureNetworking, A(ans, 'mounts', 'net-admin-interface', 'net-admin-bridge', 'net-admin-configuration', 'manual-hostname', 'manual-nameservers', 'network-hardware', 'preserve-settings', 'network-backend'), []),
         Task(prepareSwapfile, A(ans, 'mounts', 'primary-disk', 'swap-partnum', 'disk-label-suffix'), []),
         Task(writeFstab, A(ans, 'mounts', 'primary-disk', 'logs-partnum', 'swap-partnum', 'disk-label-suffix', 'fs-type'), []),
@@ -186,19 +427,26 @@ def getFinalisationSequence(ans):
         Task(writeInventory, A(ans, 'installation-uuid', 'control-domain-uuid', 'mounts', 'primary-disk',
                                'backup-partnum', 'logs-partnum', 'boot-partnum', 'swap-partnum', 'storage-partnum',
                                'guest-disks', 'net-admin-bridge',
-                               'branding', 'net-admin-configuration', 'host-config', 'install-type'), []),
-        Task(writeXencommons, A(ans, 'control-domain-uuid', 'mounts'), []),
+                               'branding', 'net-admin-configuration', 'host-config', 'install-type'), [],
+             parallel=True, files=[constants.INVENTORY_FILE]),
+        Task(writeXencommons, A(ans, 'control-domain-uuid', 'mounts'), [],
+             parallel=True, files=[constants.XENCOMMONS_FILE]),
         Task(configureISCSI, A(ans, 'mounts', 'primary-disk'), []),
-        Task(mkinitrd, A(ans, 'mounts', 'primary-disk', 'primary-partnum'), []),
-        Task(prepFallback, A(ans, 'mounts', 'primary-disk', 'primary-partnum'), []),
+        Task(prepareInitrds, A(ans, 'mounts', 'primary-disk', 'primary-partnum'), ['kernel-version']),
+        Task(mkinitrd, A(ans, 'mounts', 'kernel-version'), ['initrd']),
+        Task(logInitrdContents, A(ans, 'mounts', 'initrd'), []),
+        Task(prepFallback, A(ans, 'mounts', 'kernel-version'), []),
         Task(installBootLoader, A(ans, 'mounts', 'primary-disk',
                                   'boot-partnum', 'primary-partnum', 'branding',
                                   'disk-label-suffix', 'bootloader-location', 'write-boot-entry', 'install-type',
                                   'serial-console', 'boot-serial', 'host-config', 'fcoe-interfaces'), []),
-        Task(touchSshAuthorizedKeys, A(ans, 'mounts'), []),
-        Task(setRootPassword, A(ans, 'mounts', 'root-password'), [], args_sensitive=True),
-        Task(setTimeZone, A(ans, 'mounts', 'timezone'), []),
-        Task(writei18n, A(ans, 'mounts'), []),
+        Task(touchSshAuthorizedKeys, A(ans, 'mounts'), [],
+             parallel=True, files=['root/.ssh/authorized_keys']),
+        Task(setRootPassword, A(ans, 'mounts', 'root-password'), [], args_sensitive=True, resumable=False),
+        Task(setTimeZone, A(ans, 'mounts', 'timezone'), [],
+             parallel=True, files=['etc/localtime']),
+        Task(writei18n, A(ans, 'mounts'), [],
+             parallel=True, files=['etc/locale.conf']),
         Task(configureMCELog, A(ans, 'mounts'), []),
         Task(writeDMVSelections, A(ans, 'mounts', 'selected-multiversion-drivers'), []),
         ]
@@ -220,6 +468,7 @@ def getFinalisationSequence(ans):
     # run the users's scripts
     seq.append( Task(scripts.run_scripts, lambda a: ['filesystem-populated',  a['mounts']['root']], []) )
 
+    seq.append(Task(discardCheckpoint, A(ans, 'checkpoint', 'mounts'), []))
     seq.append(Task(umountVolumes, A(ans, 'mounts', 'cleanup'), ['cleanup']))
     seq.append(Task(writeLog, A(ans, 'primary-disk', 'primary-partnum', 'logs-partnum'), []))
 
@@ -235,6 +484,35 @@ def prettyLogAnswers(answers):
             val = answers[a]
         logger.log("%s := %s %s" % (a, val, type(val)))
 
+def taskDependencies(sequence):
+    """ Returns a list giving, for each task in sequence, the set of indices
+    of the earlier tasks that must complete before it can start.  A parallel
+    task waits for the previous barrier, for the tasks producing its inputs
+    and for earlier tasks reading or writing its outputs. """
+
+    deps = []
+    barrier = None
+    for i, task in enumerate(sequence):
+        if task.isBarrier():
+            deps.append(set(range(i)))
+            barrier = i
+            continue
+
+        inputs = set(task.inputs())
+        outputs = set(task.outputs())
+        start = 0
+        d = set()
+        if barrier is not None:
+            d.add(barrier)
+            start = barrier + 1
+        for j in range(start, i):
+            prev = sequence[j]
+            prev_outputs = set(prev.outputs())
+            if inputs & prev_outputs or outputs & (prev_outputs | set(prev.inputs())):
+                d.add(j)
+        deps.append(d)
+    return deps
+
 def executeSequence(sequence, seq_name, answers, ui, cleanup):
     answers['cleanup'] = []
     answers['ui'] = ui
@@ -250,6 +528,10 @@ def executeSequence(sequence, seq_name, answers, ui, cleanup):
             )
     logger.log("DISPATCH: NEW PHASE: %s" % seq_name)
 
+    checkpoint = answers.get('checkpoint')
+    if checkpoint:
+        checkpoint.nextPhase()
+
     def doCleanup(actions):
         for tag, f, a in actions:
             try:
@@ -261,30 +543,86 @@ def executeSequence(sequence, seq_name, answers, ui, cleanup):
         if ui:
             ui.progress.displayProgressDialog(current + x, pd)
 
+    def updateState(updated_state):
+        if len(updated_state) > 0:
+            logger.log(
+                "DISPATCH: Updated state: %s" %
+                "; ".join(["%s -> %s" % (k, v) for k, v in updated_state.items()])
+                )
+            for state_item in updated_state:
+                answers[state_item] = updated_state[state_item]
+
+    dependencies = taskDependencies(sequence)
+    pending = list(range(len(sequence)))
+    completed = set()
+    running = {}
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_TASKS)
     try:
         current = 0
-        for item in sequence:
-            if pd:
-                if item.progress_text:
-                    text = item.progress_text
-                else:
-                    text = seq_name
-
-                ui.progress.displayProgressDialog(current, pd, updated_text=text)
-            updated_state = item.execute(answers, progressCallback)
-            if len(updated_state) > 0:
-                logger.log(
-                    "DISPATCH: Updated state: %s" %
-                    "; ".join(["%s -> %s" % (k, v) for k, v in updated_state.items()])
-                    )
-                for state_item in updated_state:
-                    answers[state_item] = updated_state[state_item]
-
-            current = current + item.progress_scale
+        while pending or running:
+            # Start every task whose dependencies have completed.  Barriers
+            # only become ready once nothing else is running and execute on
+            # this thread so that they can drive the progress dialog.
+            for i in [i for i in pending if dependencies[i] <= completed]:
+                item = sequence[i]
+                pending.remove(i)
+                restored = checkpoint.restore(i, item) if checkpoint else None
+                if restored is not None:
+                    logger.log("DISPATCH: Skipping %s, completed by a previous attempt" % item.fn)
+                    updateState(restored)
+                    current = current + item.progress_scale
+                    completed.add(i)
+                    continue
+                if not item.isBarrier():
+                    logger.log("DISPATCH: Starting %s in parallel" % item.fn)
+                    running[executor.submit(item.execute, answers)] = i
+                    continue
+
+                if pd:
+                    if item.progress_text:
+                        text = item.progress_text
+                    else:
+                        text = seq_name
+
+                    ui.progress.displayProgressDialog(current, pd, updated_text=text)
+                try:
+                    state = item.execute(answers, progressCallback)
+                finally:
+                    recordTimeline(seq_name, item)
+                updateState(state)
+                current = current + item.progress_scale
+                completed.add(i)
+                if checkpoint:
+                    checkpoint.record(i, item, state)
+                    checkpoint.save(answers)
+
+            if running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    recordTimeline(seq_name, sequence[i])
+                    state = future.result()
+                    updateState(state)
+                    current = current + sequence[i].progress_scale
+                    completed.add(i)
+                    if checkpoint:
+                        checkpoint.record(i, sequence[i], state)
+                        checkpoint.save(answers)
+                if pd:
+                    ui.progress.displayProgressDialog(current, pd)
     except:
+        # Let tasks which are already running finish before cleaning up
+        # underneath them.
+        executor.shutdown(wait=True)
+        for i in running.values():
+            recordTimeline(seq_name, sequence[i])
+        writeTimeline()
         doCleanup(answers['cleanup'])
         raise
     else:
+        executor.shutdown(wait=True)
+        writeTimeline()
         if ui and pd:
             ui.progress.clearModelessDialog()
 
@@ -355,6 +693,18 @@ def performInstallation(answers, ui_package, interactive):
         assert answers['net-admin-interface'].startswith("eth")
         answers['net-admin-bridge'] = "xenbr%s" % answers['net-admin-interface'][3:]
 
+    # a failed fresh installation to the same disk resumes where it stopped:
+    answers['checkpoint'] = None
+    if answers['install-type'] == INSTALL_TYPE_FRESH:
+        answers['checkpoint'] = loadCheckpoint(answers)
+
+    # download remote packages while the disk is being prepared:
+    if constants.PREFETCH_PACKAGES:
+        sources = [(i['media'], i['address']) for i in answers.get('sources', [])]
+        if 'source-media' in answers and 'source-address' in answers:
+            sources.append((answers['source-media'], answers['source-address']))
+        repository.startPrefetch(sources + answers['extra-repos'])
+
     # perform installation:
     prep_seq = getPrepSequence(answers, interactive)
     answers_pristine = answers.copy()
@@ -730,68 +1080,114 @@ def prepareStorageRepositories(mounts, primary_disk, storage_partnum, guest_disk
     print("TYPE='%s'" % sr_type, file=fd)
     fd.close()
 
+def _scanTree(top, dirs):
+    """ Yields (mtime, allocated bytes, path) for each non-directory below
+    top, appending the same for each directory to dirs. """
+    stack = [top]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                item = (st.st_mtime, st.st_blocks * 512, entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(item)
+                    stack.append(entry.path)
+                else:
+                    yield item
+
+def _oldest(items, needed):
+    """ Returns the oldest of items, (mtime, size, path) tuples, whose sizes
+    add up to at least needed, oldest first.  Only the current selection is
+    held, in a heap with the newest at the top. """
+    heap = []
+    total = 0
+    for i, (mtime, size, path) in enumerate(items):
+        if total >= needed and mtime > -heap[0][0]:
+            # newer than everything selected, which is enough already
+            continue
+        heapq.heappush(heap, (-mtime, -i, size, path))
+        total += size
+        while total - heap[0][2] >= needed:
+            total -= heapq.heappop(heap)[2]
+    return [(-m, size, path) for m, _, size, path in sorted(heap, reverse=True)]
+
 def make_free_space(mount, required):
     """Make required bytes of free space available on mount by removing files,
     oldest first."""
 
-    def getinfo(dirpath, name):
-        path = os.path.join(dirpath, name)
-        return os.stat(path).st_mtime, path
-
     def free_space(path):
         st = os.statvfs(path)
         return st.f_bavail * st.f_frsize
 
-    if free_space(mount) >= required:
-        return
-
-    files = []
-    dirs = []
-
-    for dirpath, dirnames, filenames in os.walk(mount):
-        for i in dirnames:
-            dirs.append(getinfo(dirpath, i))
-        for i in filenames:
-            files.append(getinfo(dirpath, i))
-
-    files.sort()
-    dirs.sort()
-
-    for _, path in files:
-        os.unlink(path)
-        logger.log('Removed %s' % path)
-        if free_space(mount) >= required:
-            return
-
-    for _, path in dirs:
-        shutil.rmtree(path, ignore_errors=True)
-        logger.log('Removed %s' % path)
-        if free_space(mount) >= required:
-            return
+    start = time.time()
+    removed_files = removed_dirs = freed = 0
+    failed = set()
+    available = free_space(mount)
+    while available < required:
+        # Select enough of the oldest files to cover the shortfall based on
+        # their allocated size, and only check statvfs again once they have
+        # all gone in case that was an underestimate (e.g. hard links).
+        dirs = []
+        victims = _oldest(_scanTree(mount, dirs), required - available)
+        for _, size, path in victims:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            removed_files += 1
+            freed += size
 
-    raise RuntimeError("Failed to make enough space available on %s (%d, %d)" % (mount, required, free_space(mount)))
+        if not victims:
+            # Only directories are left
+            dirs = [d for d in dirs if d[2] not in failed]
+            if not dirs:
+                break
+            for _, size, path in _oldest(dirs, required - available):
+                shutil.rmtree(path, ignore_errors=True)
+                if os.path.lexists(path):
+                    # don't pick it again on the next pass
+                    failed.add(path)
+                    continue
+                removed_dirs += 1
+                freed += size
+        available = free_space(mount)
+
+    if removed_files or removed_dirs:
+        logger.log("Removed %d files and %d directories (%d bytes) from %s in %.1fs" %
+                   (removed_files, removed_dirs, freed, mount, time.time() - start))
+    if available < required:
+        raise RuntimeError("Failed to make enough space available on %s (%d, %d)" % (mount, required, available))
 
 ###
 # Create dom0 disk file-systems:
 
-def createDom0DiskFilesystems(install_type, disk, boot_partnum, primary_partnum, logs_partnum, disk_label_suffix, fs_type):
-    partition = partitionDevice(disk, boot_partnum)
+def makeFilesystem(what, fs_type, partition, options):
+    """ Create a filesystem, logging how long it took.  Fast mode asks
+    explicitly for the initialisation of ext inode tables to be left to the
+    kernel's ext4lazyinit thread, which mke2fs already does by default when
+    the kernel supports it.  The journal is always zeroed. """
+    if constants.FAST_MKFS and fs_type.startswith('ext'):
+        options = options + ['-E', 'lazy_itable_init=1']
+    start = time.time()
     try:
-        util.mkfs(bootfs_type, partition,
-                    ["-n", bootfs_label%disk_label_suffix.upper()])
+        util.mkfs(fs_type, partition, options)
     except Exception as e:
-        raise RuntimeError("Failed to create boot filesystem: %s" % e)
+        raise RuntimeError("Failed to create %s filesystem: %s" % (what, e))
+    logger.log("Created %s filesystem (%s) on %s in %.1fs" % (what, fs_type, partition, time.time() - start))
 
-    partition = partitionDevice(disk, primary_partnum)
-    try:
-        util.mkfs(fs_type, partition,
-                  ["-L", rootfs_label%disk_label_suffix])
-    except Exception as e:
-        raise RuntimeError("Failed to create root filesystem: %s" % e)
+def createDom0DiskFilesystems(install_type, disk, boot_partnum, primary_partnum, logs_partnum, disk_label_suffix, fs_type):
+    def createBoot():
+        makeFilesystem('boot', bootfs_type, partitionDevice(disk, boot_partnum),
+                       ["-n", bootfs_label%disk_label_suffix.upper()])
 
-    tool = PartitionTool(disk)
-    logs_partition = tool.getPartition(logs_partnum)
-    if logs_partition:
+    def createRoot():
+        makeFilesystem('root', fs_type, partitionDevice(disk, primary_partnum),
+                       ["-L", rootfs_label%disk_label_suffix])
+
+    def createLogs():
         run_mkfs = True
         change_logs_fs_type = diskutil.fs_type_from_device(partitionDevice(disk, logs_partnum)) != fs_type
 
@@ -816,11 +1212,7 @@ def createDom0DiskFilesystems(install_type, disk, boot_partnum, primary_partnum,
                     run_mkfs = False
 
         if run_mkfs:
-            try:
-                util.mkfs(fs_type, partition,
-                          ["-L", logsfs_label % disk_label_suffix])
-            except Exception as e:
-                raise RuntimeError("Failed to create logs filesystem: %s" % e)
+            makeFilesystem('logs', fs_type, partition, ["-L", logsfs_label % disk_label_suffix])
         else:
             # Ensure enough free space is available
             mount = util.TempMount(partition, 'logs-')
@@ -829,6 +1221,20 @@ def createDom0DiskFilesystems(install_type, disk, boot_partnum, primary_partnum,
             finally:
                 mount.unmount()
 
+    jobs = [createBoot, createRoot]
+    tool = PartitionTool(disk)
+    if tool.getPartition(logs_partnum):
+        jobs.append(createLogs)
+
+    # The filesystems are on different partitions, so create them at the
+    # same time; report the first failure in the order above
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [executor.submit(job) for job in jobs]
+    for f in futures:
+        f.result()
+    logger.log("Created dom0 filesystems in %.1fs" % (time.time() - start))
+
 #pylint: disable=consider-using-f-string
 def _generateBFS(mounts, primary_disk): #pylint: disable=invalid-name
     rv, wwid, err = util.runCmd2(["chroot", mounts["root"], "/usr/lib/udev/scsi_id",
@@ -841,34 +1247,6 @@ def _generateBFS(mounts, primary_disk): #pylint: disable=invalid-name
 
     util.runCmd2(["chroot", mounts["root"], "/usr/sbin/multipath", "-a", wwid])
 
-def __mkinitrd(mounts, primary_disk, partition, kernel_version):
-    if isDeviceMapperNode(partition):
-        # Generate a valid multipath configuration
-        _generateBFS(mounts, primary_disk)
-
-    # Run dracut inside dom0 chroot
-    output_file = os.path.join("/boot", "initrd-%s.img" % kernel_version)
-
-    # default to only including host specific kernel modules in initrd
-    # disable multipath on root partition
-    try:
-        if not isDeviceMapperNode(partition):
-            f = open(os.path.join(mounts['root'], 'etc/dracut.conf.d/xs_disable_multipath.conf'), 'w')
-            f.write('omit_dracutmodules+=" multipath "\n')
-            f.close()
-    except:
-        pass
-
-    cmd = ['dracut', '--verbose', '-f', output_file, kernel_version]
-
-    if util.runCmd2(['chroot', mounts['root']] + cmd) != 0:
-        raise RuntimeError("Failed to create initrd for %s.  This is often due to using an installer that is not the same version of %s as your installation source." % (kernel_version, MY_PRODUCT_BRAND))
-
-    # CA-412051: debug logging, will revert in future
-    util.runCmd2(['chroot', mounts['root'], 'ldd', '/usr/sbin/init'])
-    util.runCmd2(['chroot', mounts['root'], 'rpm', '-ql', 'systemd'])
-    util.runCmd2(['chroot', mounts['root'], 'lsinitrd', output_file])
-
 def getXenVersion(rootfs_mount):
     """ Return the xen version by interogating the package version in the chroot """
     xen_version = ['rpm', '--root', rootfs_mount, '-q', '--qf', '%{version}', 'xen-hypervisor']
@@ -951,7 +1329,9 @@ def configureISCSI(mounts, primary_disk):
     if isDeviceMapperNode(primary_disk):
         adjustISCSITimeoutForFile("%s/etc/iscsi/iscsid.conf" % mounts['root'])
 
-def mkinitrd(mounts, primary_disk, primary_partnum):
+def prepareInitrds(mounts, primary_disk, primary_partnum):
+    """ Writes the dracut configuration shared by the main and fallback
+    initrds.  Returns the kernel version to build them for. """
     xen_version = getXenVersion(mounts['root'])
     if xen_version is None:
         raise RuntimeError("Unable to determine Xen version.")
@@ -960,12 +1340,40 @@ def mkinitrd(mounts, primary_disk, primary_partnum):
         raise RuntimeError("Unable to determine kernel version.")
     partition = partitionDevice(primary_disk, primary_partnum)
 
+    if isDeviceMapperNode(partition):
+        # Generate a valid multipath configuration
+        _generateBFS(mounts, primary_disk)
+    else:
+        # disable multipath on root partition
+        try:
+            f = open(os.path.join(mounts['root'], 'etc/dracut.conf.d/xs_disable_multipath.conf'), 'w')
+            f.write('omit_dracutmodules+=" multipath "\n')
+            f.close()
+        except:
+            pass
+
+    return xen_kernel_version
+
+def mkinitrd(mounts, kernel_version):
+    # Run dracut inside dom0 chroot
+    output_file = os.path.join("/boot", "initrd-%s.img" % kernel_version)
+
+    # default to only including host specific kernel modules in initrd
+    cmd = ['dracut', '--verbose', '-f', output_file, kernel_version]
 
-    __mkinitrd(mounts, primary_disk, partition, xen_kernel_version)
+    start = time.time()
+    if util.runCmd2(['chroot', mounts['root']] + cmd) != 0:
+        raise RuntimeError("Failed to create initrd for %s.  This is often due to using an installer that is not the same version of %s as your installation source." % (kernel_version, MY_PRODUCT_BRAND))
+    logger.log("Created %s in %.1fs" % (output_file, time.time() - start))
+    return output_file
 
-def prepFallback(mounts, primary_disk, primary_partnum):
-    kernel_version =  getKernelVersion(mounts['root'])
+def logInitrdContents(mounts, initrd):
+    # CA-412051: debug logging, will revert in future.
+    util.runCmd2(['chroot', mounts['root'], 'ldd', '/usr/sbin/init'])
+    util.runCmd2(['chroot', mounts['root'], 'rpm', '-ql', 'systemd'])
+    util.runCmd2(['chroot', mounts['root'], 'lsinitrd', initrd])
 
+def prepFallback(mounts, kernel_version):
     # Copy /boot/xen-xxxx.efi to /boot/xen-fallback.efi
     xen_efi = os.path.realpath(mounts['root'] + "/boot/xen.efi")
     src = os.path.join(mounts['root'], "boot", os.path.basename(xen_efi))
@@ -989,8 +1397,10 @@ def prepFallback(mounts, primary_disk, primary_partnum):
     cmd = ['dracut', '--verbose', '--add-drivers', ' '.join(modules), '--no-hostonly']
     cmd += ['/boot/initrd-fallback.img', kernel_version]
 
+    start = time.time()
     if util.runCmd2(['chroot', mounts['root']] + cmd):
         raise RuntimeError("Failed to generate fallback initrd")
+    logger.log("Created /boot/initrd-fallback.img in %.1fs" % (time.time() - start))
 
 
 def buildBootLoaderMenu(mounts, xen_version, xen_kernel_version, boot_config, serial, boot_serial, host_config, primary_disk, disk_label_suffix, fcoe_interfaces):
@@ -1257,10 +1667,11 @@ def prepareSwapfile(mounts, primary_disk, swap_partnum, disk_label_suffix):
                 break
     else:
         util.assertDir("%s/var/swap" % mounts['root'])
-        util.runCmd2(['dd', 'if=/dev/zero',
-                      'of=%s' % os.path.join(mounts['root'], constants.swap_file.lstrip('/')),
-                      'bs=1024', 'count=%d' % (constants.swap_file_size * 1024)])
+        start = time.time()
+        copyutil.allocateFile(os.path.join(mounts['root'], constants.swap_file.lstrip('/')),
+                              constants.swap_file_size * 2**20)
         util.runCmd2(['chroot', mounts['root'], 'mkswap', constants.swap_file])
+        logger.log("Created %d MiB swap file in %.1fs" % (constants.swap_file_size, time.time() - start))
 
 def writeFstab(mounts, primary_disk, logs_partnum, swap_partnum, disk_label_suffix, fs_type):
 
@@ -112,6 +112,12 @@ kbd_data_file = '/opt/xensource/installer/keymaps'
 ANSWERFILE_PATH = '/tmp/answerfile'
 ANSWERFILE_GENERATOR_PATH = '/tmp/answerfile_generator'
 SCRIPTS_DIR = "/tmp/scripts"
+TIMELINE_FILE = "/tmp/install-timeline.json"
+SUPPORT_TARBALL = "support.tar.gz"
+# record of the commands run to collect the support tarball
+LOG_PROBES_MANIFEST = "log-probes.json"
+LOG_PROBE_TIMEOUT = 60
+FETCH_CACHE_DIR = "/tmp/fetch-cache"
 EXTRA_SCRIPTS_DIR = "/tmp/extra-scripts"
 defaults_data_file = '/opt/xensource/installer/defaults.json'
 SYSFS_IBFT_DIR = "/sys/firmware/ibft"
@@ -160,6 +166,39 @@ MPATH_ISCSI_TIMEOUT = 15
 
 ISCSI_NODES = 'var/lib/iscsi/nodes'
 
+# fetching of answerfiles and scripts
+FETCH_ATTEMPTS = 5
+FETCH_TIMEOUT = 60
+
+# number of packages verified concurrently when checking a repository
+VERIFY_WORKERS = 4
+# sha256 of packages already verified, and whether to ignore it
+VERIFY_CACHE_FILE = "/tmp/verified-packages.json"
+FORCE_VERIFY = False
+# local copy of remote repositories, downloaded while the disk is prepared
+PREFETCH_PACKAGES = True
+PREFETCH_DIR = "/tmp/prefetch"
+
+# number of disks probed concurrently when looking for existing installations
+PROBE_WORKERS = 8
+
+# number of files copied concurrently when backing up or restoring
+COPY_WORKERS = 4
+# files on a backup partition which aren't part of the backed up root
+BACKUP_MANIFEST = '.xen-backup-manifest'
+BACKUP_METADATA = ['lost+found', '.xen-backup-partition', '.xen-gpt.bin', BACKUP_MANIFEST]
+# only copy the files which changed if the backup partition already holds a
+# backup of the same root filesystem
+INCREMENTAL_BACKUP = True
+
+# leave inode table initialisation of new ext filesystems to the kernel
+# once they are mounted, even if mke2fs wouldn't by default
+FAST_MKFS = False
+
+# checkpoint of a fresh installation, relative to the logs partition
+CHECKPOINT_FILE = "installer-checkpoint.json"
+RESUME_INSTALL = True
+
 # prepare configuration for common criteria security
 CC_PREPARATIONS = False
 CC_FIREWALL_CONF = '/opt/xensource/installer/common_criteria_firewall_rules'
@@ -0,0 +1,534 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+import os
+import stat
+import errno
+import json
+import shutil
+import hashlib
+import time
+import threading
+import concurrent.futures
+
+import constants
+from xcp import logger
+
+# Data is copied, and progress reported, in chunks of this size
+CHUNK_SIZE = 8 * 2**20
+
+# Cleared the first time the kernel can't copy_file_range between the source
+# and destination (e.g. across filesystems before Linux 5.3)
+_use_copy_file_range = hasattr(os, 'copy_file_range')
+_use_sendfile = hasattr(os, 'sendfile')
+
+# Errors meaning a filesystem doesn't support some metadata, e.g. ownership
+# or xattrs on vfat, which cp -a tolerates as well
+_UNSUPPORTED = (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EINVAL)
+
+def _copyRange(fin, fout, offset, count, account):
+    """ Copy count bytes at offset of fin to the same offset of fout, in the
+    kernel if possible.  Returns the number of bytes copied, which is less
+    than count if the source is shorter than expected. """
+    global _use_copy_file_range, _use_sendfile
+
+    copied = 0
+    while copied < count:
+        n = min(CHUNK_SIZE, count - copied)
+        pos = offset + copied
+        if _use_copy_file_range:
+            try:
+                done = os.copy_file_range(fin, fout, n, pos, pos)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                _use_copy_file_range = False
+                continue
+        elif _use_sendfile:
+            try:
+                os.lseek(fout, pos, os.SEEK_SET)
+                done = os.sendfile(fout, fin, pos, n)
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL):
+                    raise
+                _use_sendfile = False
+                continue
+        else:
+            data = os.pread(fin, n, pos)
+            done = len(data)
+            written = 0
+            while written < done:
+                written += os.pwrite(fout, data[written:], pos + written)
+        if done == 0:
+            break
+        copied += done
+        account(done)
+    return copied
+
+def _dataExtents(fd, size):
+    """ Yields the (offset, length) of the data of a sparse file, skipping
+    its holes. """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # only a hole left
+                return
+            if e.errno == errno.EINVAL and offset == 0:
+                # no SEEK_DATA support
+                yield 0, size
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        if start >= size:
+            return
+        yield start, end - start
+        offset = end
+
+def _copyXattrs(src, dst, follow_symlinks=True):
+    """ Copy the extended attributes of src, including ACLs and security
+    labels, to dst (a path or, if follow_symlinks, a file descriptor). """
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            return
+        raise
+    for name in names:
+        try:
+            value = os.getxattr(src, name, follow_symlinks=False)
+            if follow_symlinks:
+                os.setxattr(dst, name, value)
+            else:
+                os.setxattr(dst, name, value, follow_symlinks=False)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+def copyMetadata(src, dst, st, remap=None):
+    """ Give dst (a path or a file descriptor) the ownership, permissions,
+    extended attributes and timestamps of src, whose lstat is st.  If given,
+    remap(st) returns the (uid, gid, mode) to give dst instead. """
+    is_fd = isinstance(dst, int)
+    is_link = stat.S_ISLNK(st.st_mode)
+    uid, gid, mode = remap(st) if remap else (st.st_uid, st.st_gid, st.st_mode)
+    try:
+        if is_fd:
+            os.fchown(dst, uid, gid)
+        else:
+            os.chown(dst, uid, gid, follow_symlinks=False)
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+    # after chown, which clears the setuid and setgid bits
+    if not is_link:
+        try:
+            os.chmod(dst, stat.S_IMODE(mode))
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    _copyXattrs(src, dst, follow_symlinks=is_fd)
+    if is_fd:
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    else:
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+def _hashZeros(digest, count):
+    zeros = bytes(min(CHUNK_SIZE, count))
+    while count > 0:
+        digest.update(zeros[:count])
+        count -= len(zeros)
+
+def _hashCopy(fd, extents, size, digest):
+    """ Update digest with the content of the file fd of size bytes, given
+    the (offset, length) of its data: holes are hashed without reading
+    them. """
+    pos = 0
+    for offset, length in extents:
+        _hashZeros(digest, offset - pos)
+        end = offset + length
+        pos = offset
+        while pos < end:
+            data = os.pread(fd, min(CHUNK_SIZE, end - pos), pos)
+            if not data:
+                raise IOError("Copy shorter than expected")
+            digest.update(data)
+            pos += len(data)
+    _hashZeros(digest, size - pos)
+
+def copyFile(src, dst, st, account=lambda n: (), remap=None, digest=None):
+    """ Copy the regular file src, whose lstat is st, and its metadata to
+    dst, keeping it sparse.  account is called with the number of bytes
+    copied (or skipped over as holes) as the copy progresses.  If given,
+    digest is updated with the content of the copy, read back once the
+    kernel has made it. """
+    fin = os.open(src, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        mode = os.O_WRONLY if digest is None else os.O_RDWR
+        fout = os.open(dst, mode | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        try:
+            if st.st_blocks * 512 < st.st_size:
+                extents = _dataExtents(fin, st.st_size)
+            else:
+                extents = [(0, st.st_size)]
+            copied = []
+            pos = 0
+            for offset, length in extents:
+                account(offset - pos)
+                n = _copyRange(fin, fout, offset, length, account)
+                copied.append((offset, n))
+                pos = offset + n
+            account(st.st_size - pos)
+            os.ftruncate(fout, st.st_size)
+            if digest is not None:
+                _hashCopy(fout, copied, st.st_size, digest)
+            copyMetadata(src, fout, st, remap)
+        finally:
+            os.close(fout)
+    finally:
+        os.close(fin)
+
+def _create(func, dst, *args):
+    """ Create a non-directory dst with func, replacing whatever is there. """
+    try:
+        func(*(args + (dst,)))
+    except FileExistsError:
+        os.unlink(dst)
+        func(*(args + (dst,)))
+
+def copyOther(src, dst, st, remap=None):
+    """ Copy src, a symbolic link or special file whose lstat is st, and its
+    metadata to dst. """
+    if stat.S_ISLNK(st.st_mode):
+        _create(os.symlink, dst, os.readlink(src))
+    else:
+        _create(lambda d: os.mknod(d, st.st_mode, st.st_rdev), dst)
+    copyMetadata(src, dst, st, remap)
+
+def allocateFile(filename, size, mode=0o600):
+    """ Create filename with size bytes all allocated on disk, as swapon
+    requires of a swap file.  The blocks are reserved with fallocate where
+    the filesystem supports it and zeroed a chunk at a time otherwise. """
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+        # Unwritten extents count towards st_blocks whereas holes don't
+        if os.fstat(fd).st_blocks * 512 < size:
+            os.ftruncate(fd, 0)
+            zeros = bytes(CHUNK_SIZE)
+            written = 0
+            while written < size:
+                written += os.write(fd, zeros[:size - written])
+            os.fsync(fd)
+            if os.fstat(fd).st_blocks * 512 < size:
+                raise RuntimeError("%s still has holes after being written" % filename)
+    finally:
+        os.close(fd)
+
+class TreeCopier(object):
+    """ Copies the tree at src into the directory dst like cp -a: ownership,
+    permissions, timestamps, extended attributes (and so ACLs), hard links,
+    symbolic links, device nodes and holes are preserved, and mount points
+    below src are crossed.
+
+    The tree is walked once by scan(), then copy() copies regular files on a
+    pool of workers, in the kernel (copy_file_range or sendfile) where
+    possible, and reports progress in bytes.
+
+    Paths relative to src listed in exclude are not copied at all;
+    directories listed in skip_contents are created empty.
+
+    If previous, the manifest of an earlier copy to dst, is given, the copy
+    is incremental: regular files whose size, mode, ownership, mtime and
+    ctime are unchanged since are not copied again, and entries no longer in
+    src are removed.  If checksum, the sha256 of each regular file is
+    computed by reading its copy back, and entries() returns manifest
+    entries for them.
+
+    remap is passed to copyMetadata to change the ownership and mode of the
+    copies as they are made. """
+
+    def __init__(self, src, dst, exclude=(), skip_contents=(), workers=None,
+                 previous=None, checksum=False, remap=None):
+        self.src = src
+        self.dst = dst
+        self.exclude = set(exclude)
+        self.skip_contents = set(skip_contents)
+        self.workers = workers or constants.COPY_WORKERS
+        self.previous = previous
+        self.checksum = checksum
+        self.remap = remap
+        # manifest entries of the regular files copied, or kept, by path
+        self.file_entries = {}
+        self.skipped_bytes = 0
+        # lists of (relative path, lstat), in top-down order
+        self.dirs = []
+        self.files = []
+        self.others = []
+        # (relative path, relative path of the first link to the same file)
+        self.links = []
+        self.total_bytes = 0
+        self.copied_bytes = 0
+        self.lock = threading.Lock()
+
+    def scan(self):
+        inodes = {}
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            with os.scandir(os.path.join(self.src, rel)) as it:
+                entries = sorted(it, key=lambda e: e.name)
+            for entry in entries:
+                path = os.path.join(rel, entry.name)
+                if path in self.exclude:
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    self.dirs.append((path, st))
+                    if path not in self.skip_contents:
+                        stack.append(path)
+                elif stat.S_ISREG(st.st_mode):
+                    if st.st_nlink > 1:
+                        key = (st.st_dev, st.st_ino)
+                        if key in inodes:
+                            self.links.append((path, inodes[key]))
+                            continue
+                        inodes[key] = path
+                    self.files.append((path, st))
+                    self.total_bytes += st.st_size
+                else:
+                    self.others.append((path, st))
+        logger.log("Scanned %s: %d directories, %d files (%d bytes), %d hard links, %d other" %
+                   (self.src, len(self.dirs), len(self.files), self.total_bytes,
+                    len(self.links), len(self.others)))
+
+    def _account(self, n):
+        with self.lock:
+            self.copied_bytes += n
+
+    def _copyFile(self, path, st):
+        dst = os.path.join(self.dst, path)
+        try:
+            if self.previous is not None:
+                # don't write through a hard link of the previous copy
+                try:
+                    os.unlink(dst)
+                except FileNotFoundError:
+                    pass
+            digest = hashlib.sha256() if self.checksum else None
+            copyFile(os.path.join(self.src, path), dst, st, self._account, self.remap, digest)
+            if self.checksum:
+                entry = _manifestEntry(self.dst, path, os.lstat(dst))
+                entry['sha256'] = digest.hexdigest()
+                # the ctime of the source, which a change of ownership,
+                # mode or xattrs updates even if the mtime is kept
+                entry['ctime'] = st.st_ctime_ns
+                with self.lock:
+                    self.file_entries[path] = entry
+        except Exception as e:
+            raise RuntimeError("Failed to copy /%s: %s" % (path, e))
+
+    def _unchanged(self, path, st):
+        """ Whether the copy of the regular file at path, whose lstat is st,
+        made when previous was written is still current. """
+        entry = self.previous.get(path)
+        if entry is None or entry['type'] != 'f' or 'sha256' not in entry:
+            return False
+        return (entry['size'], entry['mode'], entry.get('uid'), entry.get('gid'),
+                entry['mtime'], entry.get('ctime')) == \
+            (st.st_size, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid,
+             st.st_mtime_ns, st.st_ctime_ns)
+
+    def _removeStale(self):
+        """ Remove the entries of a previous copy which are gone from src, or
+        have changed type. """
+        current = dict((path, _fileType(st.st_mode)) for path, st in self.dirs + self.files + self.others)
+        for path, target in self.links:
+            current[path] = 'f'
+        stale = [path for path, entry in self.previous.items() if current.get(path) != entry['type']]
+        # children before their parents
+        for path in sorted(stale, reverse=True):
+            dst = os.path.join(self.dst, path)
+            try:
+                if os.path.isdir(dst) and not os.path.islink(dst):
+                    shutil.rmtree(dst)
+                else:
+                    os.unlink(dst)
+            except FileNotFoundError:
+                pass
+        logger.log("Removed %d entries from the previous copy" % len(stale))
+
+    def entries(self):
+        return self.file_entries
+
+    def copy(self, progress=lambda done, total: ()):
+        """ Copy the tree scanned by scan(), calling progress with the
+        number of bytes copied so far and the total from the calling
+        thread. """
+        start = time.time()
+
+        files = self.files
+        if self.previous is not None:
+            self._removeStale()
+            files = []
+            for path, st in self.files:
+                if self._unchanged(path, st):
+                    self.file_entries[path] = self.previous[path]
+                    self.skipped_bytes += st.st_size
+                else:
+                    files.append((path, st))
+            self._account(self.skipped_bytes)
+
+        for path, st in self.dirs:
+            try:
+                os.mkdir(os.path.join(self.dst, path), 0o700)
+            except FileExistsError:
+                pass
+        for path, st in self.others:
+            copyOther(os.path.join(self.src, path), os.path.join(self.dst, path), st, self.remap)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set(executor.submit(self._copyFile, path, st) for path, st in files)
+            try:
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, timeout=0.5,
+                                                            return_when=concurrent.futures.FIRST_EXCEPTION)
+                    for f in done:
+                        f.result()
+                    progress(self.copied_bytes, self.total_bytes)
+            finally:
+                for f in pending:
+                    f.cancel()
+
+        for path, target in self.links:
+            _create(os.link, os.path.join(self.dst, path), os.path.join(self.dst, target))
+        # bottom-up, so that creating entries doesn't change the timestamps
+        for path, st in reversed(self.dirs):
+            copyMetadata(os.path.join(self.src, path), os.path.join(self.dst, path), st, self.remap)
+
+        elapsed = time.time() - start
+        copied = self.copied_bytes - self.skipped_bytes
+        logger.log("Copied %s to %s: %d bytes in %.1fs (%.1f MB/s), %d bytes unchanged" %
+                   (self.src, self.dst, copied, elapsed,
+                    copied / 2**20 / max(elapsed, 0.001), self.skipped_bytes))
+        progress(self.copied_bytes, self.total_bytes)
+
+def copyPath(src, dst, remap=None):
+    """ Copy whatever is at src, including a whole directory tree, to dst
+    like cp -a, merging with a directory already at dst.  Returns the
+    number of entries copied. """
+    st = os.lstat(src)
+    if stat.S_ISDIR(st.st_mode):
+        try:
+            os.mkdir(dst, 0o700)
+        except FileExistsError:
+            pass
+        copier = TreeCopier(src, dst, remap=remap)
+        copier.scan()
+        copier.copy()
+        copyMetadata(src, dst, st, remap)
+        return 1 + len(copier.dirs) + len(copier.files) + len(copier.others) + len(copier.links)
+    elif stat.S_ISREG(st.st_mode):
+        copyFile(src, dst, st, remap=remap)
+    else:
+        copyOther(src, dst, st, remap)
+    return 1
+
+def _fileType(mode):
+    for test, name in ((stat.S_ISDIR, 'd'), (stat.S_ISREG, 'f'), (stat.S_ISLNK, 'l'),
+                       (stat.S_ISCHR, 'c'), (stat.S_ISBLK, 'b'), (stat.S_ISFIFO, 'p')):
+        if test(mode):
+            return name
+    return 's'
+
+def fileChecksum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(2**20)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def _manifestEntry(root, path, st):
+    entry = {'type': _fileType(st.st_mode), 'mode': stat.S_IMODE(st.st_mode),
+             'uid': st.st_uid, 'gid': st.st_gid, 'mtime': st.st_mtime_ns}
+    if entry['type'] == 'f':
+        entry['size'] = st.st_size
+    elif entry['type'] == 'l':
+        entry['target'] = os.readlink(os.path.join(root, path))
+    return entry
+
+def buildManifest(root, exclude=(), known=None):
+    """ Returns a manifest of the tree at root: a dict mapping the path of
+    every entry relative to root to its type, mode, ownership, mtime and,
+    for regular files, size and sha256 or, for symbolic links, target.  The
+    checksums of files which match their entry in known (e.g.
+    TreeCopier.entries()) are not computed again, and the source ctime
+    recorded there is kept. """
+    scan = TreeCopier(root, None, exclude=exclude)
+    scan.scan()
+    known = known or {}
+    manifest = {}
+    for path, st in scan.dirs + scan.files + scan.others:
+        entry = _manifestEntry(root, path, st)
+        if entry['type'] == 'f':
+            previous = known.get(path, {})
+            if dict(previous, sha256=None, ctime=None) == dict(entry, sha256=None, ctime=None):
+                entry['sha256'] = previous['sha256']
+                if 'ctime' in previous:
+                    entry['ctime'] = previous['ctime']
+            else:
+                entry['sha256'] = fileChecksum(os.path.join(root, path))
+        manifest[path] = entry
+    for path, target in scan.links:
+        manifest[path] = manifest[target]
+    return manifest
+
+def writeManifest(filename, manifest, source=None):
+    """ Write manifest to filename, recording the identity of the source of
+    the tree it describes. """
+    with open(filename + '.new', 'w') as f:
+        json.dump({'source': source, 'entries': manifest}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(filename + '.new', filename)
+
+def readManifest(filename, source=None):
+    """ Returns the manifest written to filename, or None if there is none
+    or, if source is given, it describes a copy of a different source. """
+    try:
+        with open(filename, 'r') as f:
+            data = json.load(f)
+    except IOError:
+        return None
+    if source is not None and data.get('source') != source:
+        return None
+    return data['entries']
+
+def verifyManifest(root, manifest):
+    """ Check the tree at root has every entry in manifest, with the same
+    type and size or target and, where the manifest has one, checksum.
+    Returns a list of the problems found. """
+    problems = []
+    for path in sorted(manifest):
+        expected = manifest[path]
+        try:
+            st = os.lstat(os.path.join(root, path))
+        except OSError as e:
+            problems.append("/%s: %s" % (path, e.strerror))
+            continue
+        keys = ('type', 'size', 'target')
+        actual = dict((k, v) for k, v in _manifestEntry(root, path, st).items() if k in keys)
+        expected = dict((k, v) for k, v in expected.items() if k in keys)
+        if actual != expected:
+            problems.append("/%s: expected %s, found %s" % (path, expected, actual))
+        elif 'sha256' in manifest[path] and fileChecksum(os.path.join(root, path)) != manifest[path]['sha256']:
+            problems.append("/%s: checksum differs" % path)
+    return problems
@@ -2,7 +2,10 @@
 
 import constants
 import errno
-import re, subprocess, types, os, time
+import re, subprocess, types, os, time, stat
+import bisect
+import json
+import threading
 from pprint import pprint
 from copy import copy, deepcopy
 import util
@@ -41,23 +44,28 @@ class FreePool:
         # this class maintains a usedThreshold address.  Addresses lower than the threshold
         # have already been used, and those at or above it are still available
         self.usedThreshold = usedThreshold
-
-    def freeSpace(self):
-        sizeLeft = 0
+        # Index of the first free segment ending above usedThreshold, and the space
+        # left from there on, so that each allocation doesn't rescan the whole list
+        self.nextIndex = 0
+        self.sizeLeft = 0
         for seg in self.freeSegments:
             freeSize = min(seg.size, seg.end() - self.usedThreshold)
             if freeSize > 0:
-                sizeLeft += freeSize
+                self.sizeLeft += freeSize
 
-        return sizeLeft
+    def freeSpace(self):
+        return self.sizeLeft
 
     def takeSegments(self, size):
         """Returns a LIST of segments that fill the requested size, and effectively removes
         those segments from the free pool by increasing usedThreshold"""
-        initialFreeSpace = self.freeSpace()
+        if size > self.sizeLeft:
+            raise Exception("Disk allocation failed - out of space")
+
         segsToTake = []
         sizeLeft = size
-        for seg in self.freeSegments:
+        while sizeLeft > 0:
+            seg = self.freeSegments[self.nextIndex]
             availableStart = max(seg.start, self.usedThreshold)
             sizeToTake = min(seg.end() - availableStart, sizeLeft)
             if sizeToTake > 0:
@@ -65,13 +73,12 @@ class FreePool:
                 segsToTake.append(takenSegment)
                 self.usedThreshold = takenSegment.end()
                 sizeLeft -= takenSegment.size
+            if sizeToTake <= 0 or seg.end() <= self.usedThreshold:
+                self.nextIndex += 1
             assert sizeLeft >= 0 # Underflow implies a logic error
 
-        if sizeLeft > 0:
-            raise Exception("Disk allocation failed - out of space")
-
         assert size == sum([seg.size for seg in segsToTake]) # Check we've allocated the size required
-        assert size == initialFreeSpace - self.freeSpace() # Check that free space has shrunk by the right amount
+        self.sizeLeft -= size
 
         return segsToTake
 
@@ -94,6 +101,9 @@ class LVMTool:
     VG_OTHER_SR_PREFIX = 'XSLocal'
 
     PVMOVE = ['pvmove']
+    # Largest number of extents, and of ranges, moved by a single pvmove
+    PVMOVE_MAX_EXTENTS = 4096
+    PVMOVE_MAX_RANGES = 64
     LVCHANGE = ['lvchange']
     LVREMOVE = ['lvremove']
     VGCHANGE = ['vgchange']
@@ -105,7 +115,7 @@ class LVMTool:
         'command' : ['/sbin/lvm', 'vgs'],
         'arguments' : ['--noheadings', '--nosuffix', '--units', 'b', '--separator', SEP],
         'string_options' : ['vg_name'],
-        'integer_options' : []
+        'integer_options' : ['vg_extent_size']
     }
 
     LVS_SEG_INFO = { # For one-per-LV-segment records
@@ -127,6 +137,14 @@ class LVMTool:
         'integer_options' : ['pe_start', 'pv_size', 'pv_free', 'pv_pe_count', 'dev_size']
     }
 
+    # A single report of all VGs, PVs, LVs and LV segments
+    FULLREPORT = ['/sbin/lvm', 'fullreport', '--reportformat', 'json', '--units', 'b', '--nosuffix']
+
+    # Report shared by all instances created within a sharedReport() block
+    _sharedReport = None
+    _sharedDepth = 0
+    _sharedLock = threading.Lock()
+
     def __init__(self):
         self.readAllInfo()
         self.pvsToDelete = []
@@ -146,25 +164,31 @@ class LVMTool:
                 raise Exception(str(err)+"\nError="+str(rv))
         return out
 
-    def readInfo(self, info):
+    @classmethod
+    def parseRecord(cls, info, data):
+        """ Check and convert a record read from LVM, a dict of the form
+        'option_name':value. """
+        allOptions = info['string_options'] + info['integer_options']
+        if len(data) != len(allOptions):
+            raise Exception("Wrong number of options in reply")
+        for name in info['integer_options']:
+            # Convert integer options to integer type
+            data[name] = int(data[name])
+        return data
+
+    @classmethod
+    def readInfo(cls, info):
         retVal = []
         allOptions = info['string_options'] + info['integer_options']
         cmd = info['command'] + info['arguments'] + ['--options', ','.join(allOptions)]
-        out = self.cmdWrap(cmd)
+        out = cls.cmdWrap(cmd)
 
         for line in out.strip().split('\n'):
             # skip blank lines
             if line == '':
                 continue
             try:
-                # Create a dict of the form 'option_name':value
-                data = dict(zip(allOptions, line.lstrip().split(self.SEP)))
-                if len(data) != len(allOptions):
-                    raise Exception("Wrong number of options in reply")
-                for name in info['integer_options']:
-                    # Convert integer options to integer type
-                    data[name] = int(data[name])
-                retVal.append(data)
+                retVal.append(cls.parseRecord(info, dict(zip(allOptions, line.lstrip().split(cls.SEP)))))
             except Exception as e:
                 logger.log("Discarding corrupt LVM output line '"+str(line)+"'")
                 logger.log("  Command was '"+str(cmd)+"'")
@@ -172,11 +196,80 @@ class LVMTool:
 
         return retVal
 
+    @classmethod
+    def readFullReport(cls):
+        """ Read the VGs, LVs, LV segments and PVs with a single LVM command.
+        Returns a dict of lists of records, as readInfo would. """
+        reports = (('vg', 'vgs', cls.VGS_INFO), ('lv', 'lvs', cls.LVS_INFO),
+                   ('seg', 'lvSegs', cls.LVS_SEG_INFO), ('pv', 'pvs', cls.PVS_INFO))
+        cmd = list(cls.FULLREPORT)
+        for name, _, info in reports:
+            cmd += ['--configreport', name, '--options', ','.join(info['string_options'] + info['integer_options'])]
+        out = cls.cmdWrap(cmd)
+
+        retVal = dict((key, []) for _, key, _ in reports)
+        # One entry per VG, and one for the PVs not in any VG
+        for entry in json.loads(out)['report']:
+            for name, key, info in reports:
+                for record in entry.get(name, []):
+                    # Unlike lvs, the report includes hidden LVs, e.g. '[lvol0_pmspare]'
+                    if name == 'lv' and record.get('lv_name', '').startswith('['):
+                        continue
+                    try:
+                        data = cls.parseRecord(info, dict(record))
+                        if data.get('vg_name', '').startswith('#orphans'):
+                            data['vg_name'] = ''
+                        retVal[key].append(data)
+                    except Exception as e:
+                        logger.log("Discarding corrupt LVM record '%s': %s" % (record, e))
+        return retVal
+
+    @classmethod
+    def sharedReport(cls):
+        """ Returns a context manager within which all LVMTool instances
+        share one report of the LVM configuration, e.g. to probe many disks.
+        Nothing may change the LVM configuration within the block other than
+        LVMTool.commit. """
+        class SharedReport:
+            def __enter__(self):
+                with cls._sharedLock:
+                    cls._sharedDepth += 1
+            def __exit__(self, *args):
+                with cls._sharedLock:
+                    cls._sharedDepth -= 1
+                    if cls._sharedDepth == 0:
+                        cls._sharedReport = None
+        return SharedReport()
+
+    @classmethod
+    def invalidateReport(cls):
+        with cls._sharedLock:
+            cls._sharedReport = None
+
+    @classmethod
+    def readReport(cls):
+        with cls._sharedLock:
+            report = cls._sharedReport
+            if report is None:
+                try:
+                    report = cls.readFullReport()
+                except Exception as e:
+                    logger.log("LVM full report failed, falling back to separate reports: %s" % e)
+                    report = {'vgs': cls.readInfo(cls.VGS_INFO),
+                              'lvs': cls.readInfo(cls.LVS_INFO),
+                              'lvSegs': cls.readInfo(cls.LVS_SEG_INFO),
+                              'pvs': cls.readInfo(cls.PVS_INFO)}
+                if cls._sharedDepth > 0:
+                    cls._sharedReport = report
+        # Records are annotated by instances, so each gets its own copies
+        return dict((key, [dict(record) for record in records]) for key, records in report.items())
+
     def readAllInfo(self):
-        self.vgs = self.readInfo(self.VGS_INFO)
-        self.lvs = self.readInfo(self.LVS_INFO)
-        self.lvSegs = self.readInfo(self.LVS_SEG_INFO)
-        self.pvs = self.readInfo(self.PVS_INFO)
+        report = self.readReport()
+        self.vgs = report['vgs']
+        self.lvs = report['lvs']
+        self.lvSegs = report['lvSegs']
+        self.pvs = report['pvs']
         # For DM nodes "pvs" incorrectly returns /dev/dm-n, which does not exist.
         # Replace occurrences of /dev/dm-n with the correct node under /dev/mapper/
         for pv in self.pvs:
@@ -185,6 +278,28 @@ class LVMTool:
                 n = int(name[8:])
                 pv['pv_name'] = getDeviceMapperNode(n)
 
+        # PVs by device identity, built when first needed
+        self.pvsByDevice = None
+
+        # Used segments of each device, sorted by start address.  PV segments don't record
+        # whether the segment is free space or not, so use the LV segments instead
+        self.segmentsByDevice = {}
+        for lvSeg in self.lvSegs:
+            segRange = self.decodeSegmentRange(lvSeg['seg_pe_ranges'])
+            self.segmentsByDevice.setdefault(segRange['device'], []).append(
+                Segment(segRange['start'], segRange['size']))
+        for segments in self.segmentsByDevice.values():
+            segments.sort(key=lambda x: x.start)
+
+    @staticmethod
+    def deviceKey(path):
+        """ Returns a key identifying the device (or file) at path: (major, minor)
+        for block devices. """
+        st = os.stat(path)
+        if stat.S_ISBLK(st.st_mode):
+            return (os.major(st.st_rdev), os.minor(st.st_rdev))
+        return (st.st_dev, st.st_ino, None)
+
     @classmethod
     def decodeSegmentRange(cls, segRange):
         # Handle only a single range, e.g. '/dev/sdb3:11001-16158'
@@ -207,15 +322,7 @@ class LVMTool:
         return retVal
 
     def segmentList(self, device):
-        # PV segments don't record whether the segment is free space or not, so iterate through
-        # the LV segments for the device instead
-        segments = []
-        for lvSeg in self.lvSegs:
-            segRange = self.decodeSegmentRange(lvSeg['seg_pe_ranges'])
-            if segRange['device'] == device:
-                segments.append(Segment(segRange['start'], segRange['size']))
-        segments.sort(key=lambda x: x.start)
-        return segments
+        return list(self.segmentsByDevice.get(device, []))
 
     def freeSegmentList(self, device):
         pv = self.deviceToPV(device)
@@ -239,11 +346,13 @@ class LVMTool:
         """Given a device, i.e. a partition containing an LVM volume, and a threshold in extents,
         returns the segments that would need to be moved so that all non-free segments are
         below that address.  Can add just part of a segment if the original straddles the threshold"""
+        segments = self.segmentsByDevice.get(device, [])
+        # Segments don't overlap, so their ends are sorted too
+        first = bisect.bisect_right([seg.end() for seg in segments], threshold)
         segsToMove = []
-        for seg in self.segmentList(device):
-            if seg.end() > threshold:
-                start = max(seg.start, threshold)
-                segsToMove.append(Segment(start, seg.end() - start))
+        for seg in segments[first:]:
+            start = max(seg.start, threshold)
+            segsToMove.append(Segment(start, seg.end() - start))
         return segsToMove
 
     def makeSpaceAfterThreshold(self, device, thresholdExtent):
@@ -286,10 +395,15 @@ class LVMTool:
     def deviceToPVOrNone(self, device):
         """ Returns the PV record for a given device (partition), or None if there is no PV
         for that device."""
-        for pv in self.pvs:
-            if os.path.samefile(pv['pv_name'], device):
-                return pv
-        return None
+        if self.pvsByDevice is None:
+            self.pvsByDevice = {}
+            for pv in self.pvs:
+                try:
+                    self.pvsByDevice.setdefault(self.deviceKey(pv['pv_name']), pv)
+                except OSError:
+                    # e.g. a missing PV, reported as '[unknown]'
+                    pass
+        return self.pvsByDevice.get(self.deviceKey(device))
 
     def deviceToPV(self, device):
         pv = self.deviceToPVOrNone(device)
@@ -311,6 +425,14 @@ class LVMTool:
         pv = self.deviceToPV(device)
         return pv['pv_free'] # in bytes
 
+    def extentBytes(self, device):
+        """ Returns the extent size of the VG of the PV on a device """
+        pv = self.deviceToPV(device)
+        for vg in self.vgs:
+            if vg['vg_name'] == pv['vg_name']:
+                return vg['vg_extent_size']
+        raise Exception("PV "+str(device)+" is not in a VG")
+
     def resizeDevice(self, device, byteSize):
         """ Resizes the PV on a device, moving extents around if necessary
         """
@@ -319,7 +441,7 @@ class LVMTool:
             raise Exception("Size requested for "+str(device)+" ("+str(byteSize)+
                 ") is greater than device size ("+str(pv['dev_size'])+")")
 
-        extentBytes = pv['pv_size'] // pv['pv_pe_count'] # Typically 4MiB
+        extentBytes = self.extentBytes(device) # Typically 4MiB
         # Calculate the threshold in extents beyond which segments must be moved elsewhere.
         # Round down, so enough space is freed for pvresize to complete, and allow
         # PVRESIZE_EXTENT_MARGIN for extents consumed by LVM metadata
@@ -375,10 +497,10 @@ class LVMTool:
         vgsToDelete = []
         lvsToDelete = []
 
-        for pv in self.pvs:
-            if os.path.samefile(pv['pv_name'], device):
-                pvsToDelete.append(pv['pv_name'])
-                vgsToDelete.append(pv['vg_name'])
+        pv = self.deviceToPVOrNone(device)
+        if pv is not None:
+            pvsToDelete.append(pv['pv_name'])
+            vgsToDelete.append(pv['vg_name'])
 
         for lv in self.lvs:
             if lv['vg_name'] in vgsToDelete:
@@ -405,35 +527,94 @@ class LVMTool:
                 logger.logException(e)
 
     @classmethod
-    def executeMoves(cls, progress_callback, device, moveList):
-        # Call commit instead this method unless you have special requirements
-        """Issues pvmove commands to move MoveChunks specified by the MoveList.  Doesn't
-        handle overlapping source and destination segments in a single MoveChunk, but in
-        a makeSpaceAtEnd scenario those aren't generated"""
-        sizeStep = 16 # Moving 16 extents takes only slightly more time than moving 1
-        totalExtents = sum(move.size for move in moveList)
-        extentsSoFar = 0
+    def coalesceMoves(cls, moveList):
+        """Merges MoveChunks whose source and destination both continue where the previous
+        chunk's end, so that they can be moved as one range"""
+        coalesced = []
+        for move in sorted(moveList, key=lambda x: x.src):
+            prev = coalesced[-1] if coalesced else None
+            if prev and prev.src + prev.size == move.src and prev.dest + prev.size == move.dest:
+                prev.size += move.size
+            else:
+                coalesced.append(MoveChunk(move.src, move.dest, move.size))
+        return coalesced
+
+    @classmethod
+    def batchMoves(cls, moveList):
+        """Divides MoveChunks into lists, each to be moved by a single pvmove, of no more
+        than PVMOVE_MAX_EXTENTS extents in PVMOVE_MAX_RANGES ranges"""
+        batches = []
+        batch = []
+        batchSize = 0
         for move in moveList:
             offset = 0
             while offset < move.size:
-                progress_callback((100 * extentsSoFar) / totalExtents)
-                chunkSize = min(sizeStep, move.size - offset)
-                srcRange = cls.encodeSegmentRange(device, move.src + offset, chunkSize)
-                destRange = cls.encodeSegmentRange(device, move.dest + offset, chunkSize)
-                cls.cmdWrap(cls.PVMOVE +
-                    [
-                    '--alloc',
-                    'anywhere',
-                    srcRange,
-                    destRange
-                ])
+                if batchSize == cls.PVMOVE_MAX_EXTENTS or len(batch) == cls.PVMOVE_MAX_RANGES:
+                    batches.append(batch)
+                    batch = []
+                    batchSize = 0
+                chunkSize = min(cls.PVMOVE_MAX_EXTENTS - batchSize, move.size - offset)
+                batch.append(MoveChunk(move.src + offset, move.dest + offset, chunkSize))
+                batchSize += chunkSize
                 offset += chunkSize
-                extentsSoFar += chunkSize
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @classmethod
+    def encodeSegmentRanges(cls, device, segments):
+        """Encodes a list of (start, size) pairs as one PV with several ranges, e.g.
+        '/dev/sdb3:0-15:32-47'"""
+        ranges = [cls.encodeSegmentRange(device, start, size)[len(device):] for start, size in segments]
+        return device + ''.join(ranges)
+
+    @classmethod
+    def runPvmove(cls, progress_callback, params):
+        """Runs pvmove, passing the percentage it reports having moved to progress_callback"""
+        cmd = cls.PVMOVE + ['--interval', '2'] + params
+        logger.log("Running %s" % ' '.join(cmd))
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True, close_fds=True)
+        output = []
+        for line in proc.stdout:
+            output.append(line)
+            m = re.search(r'Moved:\s*([0-9.]+)%', line)
+            if m:
+                progress_callback(float(m.group(1)))
+        rv = proc.wait()
+        if rv != 0:
+            raise Exception(''.join(output)+"\nError="+str(rv))
+
+    @classmethod
+    def executeMoves(cls, progress_callback, device, moveList, extentBytes=1):
+        # Call commit instead this method unless you have special requirements
+        """Issues pvmove commands to move MoveChunks specified by the MoveList.  Adjacent
+        chunks are merged and several ranges moved by each pvmove to amortise its overhead.
+        Doesn't handle overlapping source and destination segments in a single MoveChunk,
+        but in a makeSpaceAtEnd scenario those aren't generated"""
+        moves = cls.coalesceMoves(moveList)
+        totalBytes = sum(move.size for move in moves) * extentBytes
+        movedBytes = 0
+        for batch in cls.batchMoves(moves):
+            batchBytes = sum(move.size for move in batch) * extentBytes
+            progress_callback((100 * movedBytes) / totalBytes)
+            srcRange = cls.encodeSegmentRanges(device, [(move.src, move.size) for move in batch])
+            destRange = cls.encodeSegmentRanges(device, [(move.dest, move.size) for move in batch])
+            cls.runPvmove(lambda percent: progress_callback((100 * (movedBytes + batchBytes * percent / 100)) / totalBytes),
+                [
+                '--alloc',
+                'anywhere',
+                srcRange,
+                destRange
+            ])
+            movedBytes += batchBytes
+            logger.log("Moved %d of %d bytes on %s" % (movedBytes, totalBytes, device))
 
     def commit(self, progress_callback=lambda _ : ()):
         """Commit the changes queued up by issuing LVM commands, delete our queues as they
         succeed, and then reread the new configuration from LVM"""
         progress_callback(0)
+        self.invalidateReport()
         # Abort pvmoves if any have been left partiially completed by e.g. a crash
         self.cmdWrap(self.PVMOVE + ['--abort'])
         self.deactivateAll()
@@ -454,17 +635,17 @@ class LVMTool:
         progress_callback(4)
 
         # Process move lists.  Most of the code here is for calculating smoothly
-        # increasing progress values
-        totalExtents = 0
-        for moveList in self.moveLists.values():
-            totalExtents += sum([ move.size for move in moveList ])
-        extentsSoFar = 0
+        # increasing progress values, from the number of bytes moved
+        totalBytes = 0
+        for device, moveList in self.moveLists.items():
+            totalBytes += sum([ move.size for move in moveList ]) * self.extentBytes(device)
+        bytesSoFar = 0
 
         for device, moveList in sorted(self.moveLists.items()):
-            thisSize = sum([ move.size for move in moveList ])
-            callback = lambda percent : (progress_callback( 5 + (98 - 5) * (extentsSoFar + thisSize * percent / 100) / totalExtents) )
-            self.executeMoves(callback, device, moveList)
-            extentsSoFar +=  thisSize
+            thisBytes = sum([ move.size for move in moveList ]) * self.extentBytes(device)
+            callback = lambda percent : (progress_callback( 5 + (98 - 5) * (bytesSoFar + thisBytes * percent / 100) / totalBytes) )
+            self.executeMoves(callback, device, moveList, self.extentBytes(device))
+            bytesSoFar +=  thisBytes
         self.moveLists = {}
 
         # Process resize list
@@ -473,6 +654,7 @@ class LVMTool:
             self.cmdWrap(self.PVRESIZE + ['--setphysicalvolumesize', str(resize['bytesize']//1024)+'k', resize['device']])
         self.resizeList = []
 
+        self.invalidateReport()
         self.readAllInfo() # Reread the new LVM configuration
         progress_callback(99)
         self.deactivateAll() # Stop active LVs preventing changes to the partition structure
@@ -3,6 +3,8 @@
 import re, sys
 import os.path
 import errno
+import json
+import threading
 import constants
 import fcntl
 import glob
@@ -39,6 +41,7 @@ def wait_for_multipathd():
 def mpath_part_scan(force=False):
     global use_mpath
 
+    disk_inventory.invalidate()
     if not force and not use_mpath:
         return 0
     ret = createMpathPartnodes()
@@ -74,6 +77,7 @@ def mpath_disable():
     util.runCmd2(['killall','multipathd'])
     util.runCmd2(['/sbin/multipath','-F'])
     use_mpath = False
+    disk_inventory.invalidate()
 
 # hd* -> (ide has majors 3, 22, 33, 34, 56, 57, 88, 89, 90, 91, each major has
 # two disks, with minors 0... and 64...)
@@ -117,42 +121,146 @@ for major in range(48, 56):
 # /dev/mmcblk: mmcblk has major 179, each device usually (per kernel) has 7 minors
 disk_nodes += [ (179, x * 8) for x in range(32) ]
 
-def getDiskList():
-    # read the partition tables:
-    parts = open("/proc/partitions")
-    partlines = [re.sub(" +", " ", x).strip() for x in parts.readlines()]
-    parts.close()
+def _readBlockAttributes(name):
+    """ Read the attributes of /sys/block/<name> shown on the disk screens. """
+    path = "/sys/block/%s" % name
 
-    # parse it:
-    disks = []
-    for l in partlines:
+    def read(attr, default):
         try:
-            (major, minor, size, name) = l.split(" ")
-            (major, minor, size) = (int(major), int(minor) % 256, int(size))
-            if hasDeviceMapperHolder("/dev/" + name.replace("!","/")):
-                # skip device that cannot be used
+            return __readOneLineFile__("%s/%s" % (path, attr))
+        except (IOError, OSError):
+            return default
+
+    size = read("device/block/size", None) or read("size", "0")
+    blocksize = read("queue/logical_block_size", None)
+    return {'vendor': read("device/vendor", "").strip(' \n'),
+            'model': read("device/model", "").strip('  \n'),
+            'size': int(size),
+            'blocksize': blocksize and int(blocksize)}
+
+class BlockDeviceInventory(object):
+    """ A snapshot of the block devices on the host, read in one pass over
+    /sys/block plus a single lsblk call, so that the disk screens don't have
+    to read sysfs and fork helpers for every attribute of every disk.
+
+    The snapshot is discarded when /proc/partitions, /proc/mdstat or
+    /dev/mapper change (i.e. after udev has added or removed devices) and on
+    explicit rescans through invalidate(). """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.signature = None
+        self.snapshot = None
+
+    def invalidate(self):
+        with self.lock:
+            self.signature = None
+            self.snapshot = None
+
+    @staticmethod
+    def _signature():
+        sig = []
+        for path in ("/proc/partitions", "/proc/mdstat"):
+            try:
+                with open(path) as f:
+                    sig.append(f.read())
+            except IOError:
+                sig.append(None)
+        try:
+            sig.append(tuple(sorted(os.listdir("/dev/mapper"))))
+        except OSError:
+            sig.append(None)
+        return tuple(sig)
+
+    def _scan(self, signature):
+        partitions = []
+        for l in signature[0].splitlines():
+            try:
+                (major, minor, size, name) = l.split()
+                partitions.append((int(major), int(minor), int(size), name))
+            except ValueError:
+                # it wasn't an actual entry, maybe the headers or something:
                 continue
-            if isDeviceMapperNode("/dev/" + name.replace("!","/")):
-                # dm-* devices get added later as mapper/* devices
+
+        types = {}
+        rc, out = util.runCmd2(['/bin/lsblk', '--json', '-l', '-o', 'MAJ:MIN,TYPE'], with_stdout=True)
+        if rc == 0:
+            try:
+                for dev in json.loads(out)['blockdevices']:
+                    types[tuple(map(int, dev['maj:min'].split(':')))] = dev['type']
+            except (ValueError, KeyError) as e:
+                logger.log("Failed to parse lsblk output: %s" % e)
+
+        devices = {}
+        holders = {}
+        for name in sorted(os.listdir("/sys/block")):
+            try:
+                devno = dev_from_sysfs("/sys/block/%s" % name)
+                holders[name] = os.listdir("/sys/block/%s/holders" % name)
+            except (IOError, OSError, ValueError):
                 continue
-            if (major, minor) in disk_nodes:
-                if major == 202 and isRemovable("/dev/" + name): # Ignore PV CDROM devices
-                    continue
-                disks.append(name.replace("!", "/"))
-            # Handle LOCAL/EXPERIMENTAL and Block Extended Major devices
-            if 240 <= major <= 254 or major == 259:
-                rc, out = util.runCmd2(['/bin/lsblk', '-d', '-n', '-o', 'TYPE', "/dev/" + name.replace("!","/")],
-                                       with_stdout=True)
-                if rc == 0 and out.strip() not in ['part', 'md']:
-                    disks.append(name.replace("!", "/"))
+            info = _readBlockAttributes(name)
+            info.update({'name': name, 'type': types.get(devno), 'holders': holders[name],
+                         'slaves': [], 'serial': None})
+            devices[devno] = info
+        by_name = dict((info['name'], info) for info in devices.values())
+        for name in sorted(holders):
+            for holder in holders[name]:
+                if holder in by_name:
+                    by_name[holder]['slaves'].append('/dev/' + name.replace("!", "/"))
+
+        return {'partitions': partitions, 'devices': devices,
+                'mpath': getMpathNodes(), 'md': getMdNodes()}
+
+    def get(self):
+        with self.lock:
+            signature = self._signature()
+            if self.snapshot is None or signature != self.signature:
+                self.snapshot = self._scan(signature)
+                # dmsetup may create /dev/mapper as a side effect of the scan
+                self.signature = self._signature()
+                logger.log("Block device inventory: %d devices" % len(self.snapshot['devices']))
+            return self.snapshot
+
+    def lookup(self, dev):
+        """ Return the inventory entry of a whole-disk device node, or None. """
+        try:
+            devno = dev_from_devpath(dev)
+        except OSError:
+            return None
+        return self.get()['devices'].get(devno)
 
-        except:
-            # it wasn't an actual entry, maybe the headers or something:
+disk_inventory = BlockDeviceInventory()
+
+def getDiskList():
+    inventory = disk_inventory.get()
+    dm_major = getDeviceMapperMaj()
+
+    disks = []
+    for (major, full_minor, size, name) in inventory['partitions']:
+        minor = full_minor % 256
+        info = inventory['devices'].get((major, full_minor))
+        if not os.path.exists("/dev/" + name.replace("!","/")):
+            continue
+        if info and [h for h in info['holders'] if h.startswith('dm-')]:
+            # skip device that cannot be used
+            continue
+        if major == dm_major:
+            # dm-* devices get added later as mapper/* devices
             continue
+        if (major, minor) in disk_nodes:
+            if major == 202 and isRemovable("/dev/" + name): # Ignore PV CDROM devices
+                continue
+            disks.append(name.replace("!", "/"))
+        # Handle LOCAL/EXPERIMENTAL and Block Extended Major devices
+        if 240 <= major <= 254 or major == 259:
+            if info and info['type'] not in [None, 'part', 'md']:
+                disks.append(name.replace("!", "/"))
+
     # Add multipath nodes to list
-    disks.extend([node.replace('/dev/','') for node in getMpathNodes()])
+    disks.extend([node.replace('/dev/','') for node in inventory['mpath']])
     # Add md RAID nodes to list
-    disks.extend([node.replace('/dev/','') for node in getMdNodes()])
+    disks.extend([node.replace('/dev/','') for node in inventory['md']])
 
     return disks
 
@@ -230,24 +338,30 @@ def __readOneLineFile__(filename):
     except Exception as e:
         raise e
 
+def _deviceSlaves(dev):
+    info = disk_inventory.lookup(dev)
+    if info is not None:
+        return info['slaves']
+    return getDeviceSlaves(dev)
+
+def _blockAttributes(dev):
+    info = disk_inventory.lookup(dev)
+    if info is None:
+        info = _readBlockAttributes(re.match("/dev/(.*)", dev).group(1).replace("/", "!"))
+    return info
+
 def getDiskDeviceVendor(dev):
 
     # For Multipath nodes return info about 1st slave
     if not dev.startswith("/dev/"):
         dev = '/dev/' + dev
     if isDeviceMapperNode(dev):
-        return getDiskDeviceVendor(getDeviceSlaves(dev)[0])
+        return getDiskDeviceVendor(_deviceSlaves(dev)[0])
     if is_raid(dev):
-        vendors = set(map(getDiskDeviceVendor, getDeviceSlaves(dev)))
+        vendors = set(map(getDiskDeviceVendor, _deviceSlaves(dev)))
         return '/'.join(vendors)
 
-    if dev.startswith("/dev/"):
-        dev = re.match("/dev/(.*)", dev).group(1)
-    dev = dev.replace("/", "!")
-    if os.path.exists("/sys/block/%s/device/vendor" % dev):
-        return __readOneLineFile__("/sys/block/%s/device/vendor" % dev).strip(' \n')
-    else:
-        return ""
+    return _blockAttributes(dev)['vendor']
 
 def getDiskDeviceModel(dev):
 
@@ -255,18 +369,12 @@ def getDiskDeviceModel(dev):
     if not dev.startswith("/dev/"):
         dev = '/dev/' + dev
     if isDeviceMapperNode(dev):
-        return getDiskDeviceModel(getDeviceSlaves(dev)[0])
+        return getDiskDeviceModel(_deviceSlaves(dev)[0])
     if is_raid(dev):
-        models = set(map(getDiskDeviceModel, getDeviceSlaves(dev)))
+        models = set(map(getDiskDeviceModel, _deviceSlaves(dev)))
         return '/'.join(models)
 
-    if dev.startswith("/dev/"):
-        dev = re.match("/dev/(.*)", dev).group(1)
-    dev = dev.replace("/", "!")
-    if os.path.exists("/sys/block/%s/device/model" % dev):
-        return __readOneLineFile__("/sys/block/%s/device/model" % dev).strip('  \n')
-    else:
-        return ""
+    return _blockAttributes(dev)['model']
 
 def getDiskDeviceSize(dev):
 
@@ -274,45 +382,43 @@ def getDiskDeviceSize(dev):
     if not dev.startswith("/dev/"):
         dev = '/dev/' + dev
     if isDeviceMapperNode(dev):
-        return getDiskDeviceSize(getDeviceSlaves(dev)[0])
+        return getDiskDeviceSize(_deviceSlaves(dev)[0])
 
-    if dev.startswith("/dev/"):
-        dev = re.match("/dev/(.*)", dev).group(1)
-    dev = dev.replace("/", "!")
-    if os.path.exists("/sys/block/%s/device/block/size" % dev):
-        return int(__readOneLineFile__("/sys/block/%s/device/block/size" % dev))
-    elif os.path.exists("/sys/block/%s/size" % dev):
-        return int(__readOneLineFile__("/sys/block/%s/size" % dev))
-
-    return 0
+    return _blockAttributes(dev)['size']
 
 def getDiskBlockSize(dev):
     if not dev.startswith("/dev/"):
         dev = '/dev/' + dev
     if isDeviceMapperNode(dev):
-        return getDiskBlockSize(getDeviceSlaves(dev)[0])
-    if dev.startswith("/dev/"):
-        dev = re.match("/dev/(.*)", dev).group(1)
-    dev = dev.replace("/", "!")
-    return int(__readOneLineFile__("/sys/block/%s/queue/logical_block_size"
-                                   % dev))
+        return getDiskBlockSize(_deviceSlaves(dev)[0])
+    blocksize = _blockAttributes(dev)['blocksize']
+    if blocksize is None:
+        raise Exception("Unable to read the logical block size of %s" % dev)
+    return blocksize
 
 def getDiskSerialNumber(dev):
     # For Multipath nodes return info about 1st slave
     if not dev.startswith("/dev/"):
         dev = '/dev/' + dev
     if isDeviceMapperNode(dev):
-        return getDiskSerialNumber(getDeviceSlaves(dev)[0])
+        return getDiskSerialNumber(_deviceSlaves(dev)[0])
     if is_raid(dev):
-        serials = set(map(getDiskSerialNumber, getDeviceSlaves(dev)))
+        serials = set(map(getDiskSerialNumber, _deviceSlaves(dev)))
         return '/'.join(serials)
 
+    info = disk_inventory.lookup(dev)
+    if info is not None and info['serial'] is not None:
+        return info['serial']
+
+    serial = ""
     rc, out = util.runCmd2(['/bin/sdparm', '-q', '-i', '-p', 'sn', dev], with_stdout=True)
     if rc == 0:
         lines = out.split('\n')
         if len(lines) >= 2:
-            return lines[1].strip()
-    return ""
+            serial = lines[1].strip()
+    if info is not None:
+        info['serial'] = serial
+    return serial
 
 def isRemovable(path):
 
@@ -410,13 +516,13 @@ def getHumanDiskName(disk):
     if not disk.startswith("/dev/"):
         disk = '/dev/' + disk
     if isDeviceMapperNode(disk):
-        return getHumanDiskName(getDeviceSlaves(disk)[0])
+        return getHumanDiskName(_deviceSlaves(disk)[0])
     if is_raid(disk):
         name = getMdDeviceName(disk)
         # mdadm may append an _ followed by a number (e.g. d0_0) to prevent
         # name collisions. Strip it if necessary.
         name = re.match("([^_]*)(_\d+)?$", name).group(1)
-        return 'RAID: %s(%s)' % (name, ','.join(dev[5:] for dev in getDeviceSlaves(disk)))
+        return 'RAID: %s(%s)' % (name, ','.join(dev[5:] for dev in _deviceSlaves(disk)))
 
     if disk.startswith('/dev/disk/by-id/'):
         return disk[16:]
@@ -796,6 +902,7 @@ def process_ibft(ui, interactive):
 
     util.runCmd2(util.udevsettleCmd())
     time.sleep(5)
+    disk_inventory.invalidate()
 
     rv, out = util.runCmd2([ 'iscsiadm', '-m', 'session', '-P', '3' ],
                            with_stdout=True)
@@ -815,6 +922,7 @@ def release_ibft_disks():
         util.runCmd2([ '/sbin/iscsiadm', '-m', 'session', '-u'])
         util.runCmd2([ '/sbin/iscsiadm', '-k', '0'])
         iscsi_disks = []
+        disk_inventory.invalidate()
 
 
 def is_raid(disk):
@@ -866,6 +974,30 @@ def parentdev_from_devpath(devpath):
     # If there is no parent of the parent cannot be determined...
     return None
 
+def getFilesystemInfo(devices):
+    """ Returns a dict mapping each of devices to a dict with the filesystem
+    type, filesystem label and partition label ('fstype', 'label' and
+    'partlabel') as recorded by udev, using a single lsblk call.  Devices
+    lsblk doesn't report are left out. """
+    rc, out = util.runCmd2(['/bin/lsblk', '--json', '-l', '-o', 'MAJ:MIN,FSTYPE,LABEL,PARTLABEL'],
+                           with_stdout=True)
+    if rc != 0:
+        raise Exception("Failed to list filesystems")
+    by_devno = {}
+    for dev in json.loads(out)['blockdevices']:
+        by_devno[tuple(map(int, dev['maj:min'].split(':')))] = \
+            dict((key, dev.get(key) or '') for key in ('fstype', 'label', 'partlabel'))
+
+    info = {}
+    for device in devices:
+        try:
+            devno = dev_from_devpath(device)
+        except OSError:
+            continue
+        if devno in by_devno:
+            info[device] = by_devno[devno]
+    return info
+
 def fs_type_from_device(device):
     (rc, stdout) = util.runCmd2(['/bin/lsblk', '-n', '-o', 'FSTYPE', device], with_stdout=True)
     if rc == 0:
@@ -5,6 +5,7 @@ import os.path
 import constants
 import util
 import netutil
+import diskutil
 from util import dev_null
 from xcp import logger
 from disktools import *
@@ -86,6 +87,7 @@ def start_fcoe(interfaces):
     # of seconds for FCoE to stabilize.
     time.sleep(30)
     util.runCmd2(util.udevsettleCmd())
+    diskutil.disk_inventory.invalidate()
     for interface, status in result.items():
         if status == 'OK':
             logger.log(get_luns_on_intf(interface))
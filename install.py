@@ -133,6 +133,18 @@ def go(ui, args, answerfile_address, answerfile_script):
         elif opt == "--cc-preparations":
             constants.CC_PREPARATIONS = True
             results['network-backend'] = constants.NETWORK_BACKEND_BRIDGE
+        elif opt == "--verify-workers":
+            constants.VERIFY_WORKERS = int(val)
+        elif opt == "--force-verify":
+            constants.FORCE_VERIFY = True
+        elif opt == "--no-prefetch":
+            constants.PREFETCH_PACKAGES = False
+        elif opt == "--no-resume":
+            constants.RESUME_INSTALL = False
+        elif opt == "--full-backup":
+            constants.INCREMENTAL_BACKUP = False
+        elif opt == "--fast-mkfs":
+            constants.FAST_MKFS = True
         elif opt == "--mount":
             disktools.DeviceMounter.addMountPoints(val)
 
@@ -20,6 +20,7 @@ from xcp import logger
 import xml.dom.minidom
 import simplejson as json
 import glob
+import concurrent.futures
 
 class SettingsNotAvailable(Exception):
     pass
@@ -572,27 +573,56 @@ class XenServerBackup:
     def __repr__(self):
         return "<XenServerBackup: %s (%s) on %s>" % (str(self), self.detailed_version, self.partition)
 
+def isBackupCandidate(info):
+    """ Whether a partition with the filesystem info returned by
+    diskutil.getFilesystemInfo may hold a backup: backups are unlabelled
+    copies of a root filesystem, never on a partition the installer
+    labelled for another use. """
+    if info['fstype'] not in ('ext2', 'ext3', 'ext4', 'xfs'):
+        return False
+    if info['label']:
+        return False
+    return info['partlabel'] not in (constants.rootpart_label, constants.storagepart_label,
+                                     constants.bootpart_label, constants.logspart_label,
+                                     constants.swappart_label)
+
 def findXenSourceBackups():
     """Scans the host and find partitions containing backups of XenSource
     products.  Returns a list of device node paths to partitions containing
     said backups. """
     partitions = diskutil.getQualifiedPartitionList()
-    backups = []
 
-    for p in partitions:
+    # Only mount the partitions which look like backups
+    try:
+        fsinfo = diskutil.getFilesystemInfo(partitions)
+        candidates = [p for p in partitions if p in fsinfo and isBackupCandidate(fsinfo[p])]
+        logger.log("Backup candidates: %s of %d partitions" % (candidates, len(partitions)))
+    except Exception as e:
+        logger.log("Unable to read filesystem labels, checking every partition: %s" % e)
+        candidates = partitions
+
+    def probe(p):
+        backup = None
         b = None
         try:
             b = util.TempMount(p, 'backup-', ['ro'])
             if os.path.exists(os.path.join(b.mount_point, '.xen-backup-partition')):
                 backup = XenServerBackup(p, b.mount_point)
                 logger.log("Found a backup: %s" % (repr(backup),))
-                if backup.version >= XENSERVER_MIN_VERSION and \
-                        backup.version <= THIS_PLATFORM_VERSION:
-                    backups.append(backup)
         except:
             pass
         if b:
             b.unmount()
+        return backup
+
+    backups = []
+    if candidates:
+        workers = min(constants.PROBE_WORKERS, len(candidates))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for backup in executor.map(probe, candidates):
+                if backup and backup.version >= XENSERVER_MIN_VERSION and \
+                        backup.version <= THIS_PLATFORM_VERSION:
+                    backups.append(backup)
 
     return backups
 
@@ -603,9 +633,7 @@ def findXenSourceProducts():
     Currently requires supervisor privileges due to mounting
     filesystems."""
 
-    installs = []
-
-    for disk_device in diskutil.getQualifiedDiskList():
+    def probe(disk_device):
         disk = diskutil.probeDisk(disk_device)
 
         inst = None
@@ -616,7 +644,18 @@ def findXenSourceProducts():
             logger.log("A problem occurred whilst scanning for existing installations:")
             logger.logException(e)
             logger.log("This is not fatal.  Continuing anyway.")
+        return inst
 
+    # Disks are probed concurrently, sharing one LVM report, but the
+    # installations are returned in disk order
+    with LVMTool.sharedReport():
+        disks = diskutil.getQualifiedDiskList()
+        workers = max(1, min(constants.PROBE_WORKERS, len(disks)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(probe, disks))
+
+    installs = []
+    for inst in results:
         if inst:
             logger.log("Found an installation: %s" % (repr(inst),))
             installs.append(inst)
@@ -2,7 +2,9 @@
 
 # SPDX-License-Identifier: GPL-2.0-only
 
+import constants
 import diskutil
+import disktools
 import ftplib
 import os.path
 import netutil
@@ -88,17 +90,18 @@ def get_local_disk(answers):
     entries = []
     target_is_sr = {}
 
-    for de in diskEntries:
-        (vendor, model, size) = diskutil.getExtendedDiskInfo(de)
-        # determine current usage
-        target_is_sr[de] = False
-        disk = diskutil.probeDisk(de)
-        if disk.storage[0]:
-            target_is_sr[de] = True
-        (vendor, model, size) = diskutil.getExtendedDiskInfo(de)
-        stringEntry = "%s - %s [%s %s]" % (diskutil.getHumanDiskName(de), diskutil.getHumanDiskSize(size), vendor, model)
-        e = (stringEntry, de)
-        entries.append(e)
+    with disktools.LVMTool.sharedReport():
+        for de in diskEntries:
+            (vendor, model, size) = diskutil.getExtendedDiskInfo(de)
+            # determine current usage
+            target_is_sr[de] = False
+            disk = diskutil.probeDisk(de)
+            if disk.storage[0]:
+                target_is_sr[de] = True
+            (vendor, model, size) = diskutil.getExtendedDiskInfo(de)
+            stringEntry = "%s - %s [%s %s]" % (diskutil.getHumanDiskName(de), diskutil.getHumanDiskSize(size), vendor, model)
+            e = (stringEntry, de)
+            entries.append(e)
 
     # default value:
     default = None
@@ -314,8 +317,8 @@ def main(args):
             a = xcp.accessor.createAccessor(dest, False)
             logger.log("Saving report to: " + str(a))
             a.start()
-            fh = open('/tmp/support.tar.bz2')
-            a.writeFile(fh, 'support.tar.bz2')
+            fh = open(os.path.join('/tmp', constants.SUPPORT_TARBALL), 'rb')
+            a.writeFile(fh, constants.SUPPORT_TARBALL)
             fh.close()
             a.finish()
             report_saved = True
@@ -6,7 +6,9 @@ import glob
 import errno
 import hashlib
 import tempfile
-import urllib.request, urllib.parse
+import urllib.request, urllib.parse, urllib.error
+import http.client
+import base64
 import ftplib
 import signal
 import subprocess
@@ -14,13 +16,17 @@ import re
 import gzip
 import shutil
 import time
-from io import BytesIO
+import json
+import threading
+import concurrent.futures
 from xml.dom.minidom import parse
+from xml.etree import ElementTree
 
 import diskutil
 import hardware
 import version
 import util
+import constants
 from util import dev_null
 from xcp.version import *
 from xcp import logger
@@ -57,27 +63,46 @@ class Repository(object):
     def accessor(self):
         return self._accessor
 
-    def check(self, progress=lambda x: ()):
-        """ Return a list of problematic packages. """
-        def pkg_progress(start, end):
+    def check(self, progress=lambda x: (), force=None):
+        """ Return a list of problematic packages.  Packages are verified
+        by a pool of up to constants.VERIFY_WORKERS threads, or one at a
+        time from a device; progress is reported from the calling thread.  If force is set, packages found in the
+        verified package cache are hashed again (default:
+        constants.FORCE_VERIFY). """
+        if force is None:
+            force = constants.FORCE_VERIFY
+        packages = list(self._packages)
+        total_size = sum((p.size for p in packages)) or 1
+        checked = [0] * len(packages)
+        lock = threading.Lock()
+
+        def pkg_progress(i):
             def progress_fn(x):
-                progress(start + ((x * (end - start)) / 100))
+                with lock:
+                    checked[i] = (x * packages[i].size) / 100
             return progress_fn
 
+        def check_package(i):
+            valid = packages[i].check(False, pkg_progress(i), force)
+            with lock:
+                checked[i] = packages[i].size
+            return valid
+
         self._accessor.start()
 
         try:
-            problems = []
-            total_size = sum((p.size for p in self._packages))
-            total_progress = 0
-            for p in self._packages:
-                start = (total_progress * 100) / total_size
-                end = ((total_progress + p.size) * 100) / total_size
-                if not p.check(False, pkg_progress(start, end)):
-                    problems.append(p)
-                total_progress += p.size
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._accessor.concurrentReads()) as executor:
+                futures = [executor.submit(check_package, i) for i in range(len(packages))]
+                not_done = futures
+                while not_done:
+                    _, not_done = concurrent.futures.wait(not_done, timeout=0.5)
+                    with lock:
+                        total_progress = sum(checked)
+                    progress((total_progress * 100) / total_size)
+            problems = [p for p, f in zip(packages, futures) if not f.result()]
         finally:
             self._accessor.finish()
+            verified_packages.save()
         return problems
 
     def __iter__(self):
@@ -128,37 +153,97 @@ class YumRepository(Repository):
         repomdfp = accessor.openAddress(self.REPOMD_FILENAME)
         repomd_xml = parse(repomdfp)
         xml_datas = repomd_xml.getElementsByTagName("data")
+        self._groups_location = None
         for data_node in xml_datas:
             data = data_node.getAttribute("type")
             if data == "primary":
                 primary_location = data_node.getElementsByTagName("location")
                 primary_location = primary_location[0].getAttribute("href")
+            elif data == "group" or (data == "group_gz" and self._groups_location is None):
+                self._groups_location = data_node.getElementsByTagName("location")[0].getAttribute("href")
         repomdfp.close()
 
         primaryfp = accessor.openAddress(primary_location)
+        try:
+            with gzip.GzipFile("", "r", fileobj=primaryfp) as xml:
+                self._packages = list(self._iter_primary(xml))
+        finally:
+            primaryfp.close()
+
+    def _iter_primary(self, xml):
+        """ Stream the <package> elements of primary.xml, yielding an
+        RPMPackage for each one as soon as it has been read. """
+        def local(tag):
+            return tag.rsplit('}', 1)[-1]
+
+        root = None
+        for event, elem in ElementTree.iterparse(xml, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            if local(elem.tag) != 'package':
+                continue
 
-        # HTTP&FTP accessors don't implement tell(): read xml using BytesIO to gunzip it
-        with BytesIO(primaryfp.read()) as fp, gzip.GzipFile("", "r", fileobj=fp) as xml:
-            dom = parse(xml)
-            package_names = dom.getElementsByTagName("location")
-            package_sizes = dom.getElementsByTagName("size")
-            package_checksums = dom.getElementsByTagName("checksum")
-
-        primaryfp.close()
-
-        # Filter using only sha256 checksum
-        sha256_checksums = [x for x in package_checksums if x.getAttribute("type") == "sha256"]
-
-        # After the filter, the list of checksums will have the same size
-        # of the list of names
-        self._packages = []
-        for name_node, size_node, checksum_node in zip(package_names, package_sizes, sha256_checksums):
-            name = name_node.getAttribute("href")
-            size = size_node.getAttribute("package")
-            checksum = checksum_node.childNodes[0]
-            pkg = RPMPackage(self, name, size, checksum.data)
+            name = size = checksum = None
+            rpm_name = None
+            provides = set()
+            requires = set()
+            for child in elem:
+                tag = local(child.tag)
+                if tag == 'location':
+                    name = child.get('href')
+                elif tag == 'size':
+                    size = child.get('package')
+                elif tag == 'checksum' and child.get('type') == 'sha256':
+                    checksum = child.text.strip()
+                elif tag == 'name':
+                    rpm_name = child.text.strip()
+                elif tag == 'format':
+                    for item in child:
+                        tag = local(item.tag)
+                        if tag == 'provides':
+                            provides.update(e.get('name') for e in item)
+                        elif tag == 'requires':
+                            requires.update(e.get('name') for e in item if not e.get('name').startswith('rpmlib('))
+                        elif tag == 'file':
+                            provides.add(item.text.strip())
+
+            # Drop the element to keep memory usage independent of the
+            # size of the repository
+            root.clear()
+
+            if name is None or size is None or checksum is None:
+                logger.log("Ignoring package %s without location, size or sha256 checksum" % name)
+                continue
+            pkg = RPMPackage(self, name, size, checksum)
             pkg.type = 'rpm'
-            self._packages.append(pkg)
+            if rpm_name:
+                provides.add(rpm_name)
+            pkg.provides = provides
+            pkg.requires = requires
+            yield pkg
+
+    def groupPackages(self, group):
+        """ Returns the names of the mandatory and default packages of group
+        in the repository's comps data, or None if it has no such group. """
+        if getattr(self, '_groups', None) is None:
+            self._groups = {}
+            if getattr(self, '_groups_location', None):
+                fp = self._accessor.openAddress(self._groups_location)
+                try:
+                    if self._groups_location.endswith('.gz'):
+                        with gzip.GzipFile("", "r", fileobj=fp) as xml:
+                            comps = ElementTree.parse(xml).getroot()
+                    else:
+                        comps = ElementTree.parse(fp).getroot()
+                finally:
+                    fp.close()
+                for elem in comps.findall('group'):
+                    self._groups[elem.findtext('id')] = [
+                        req.text.strip() for req in elem.iter('packagereq')
+                        if req.get('type', 'mandatory') in ('mandatory', 'default')]
+        return self._groups.get(group)
 
     def __repr__(self):
         return "%s@yum" % self._identifier
@@ -186,21 +271,13 @@ class YumRepository(Repository):
 
     def _installPackages(self, progress_callback, mounts):
         assert self._targets is not None
-        url = self._accessor.url()
-        logger.log("URL: " + str(url))
         with open('/root/yum.conf', 'w') as yum_conf:
             yum_conf.write(self._yum_conf)
             yum_conf.write("""
 [install]
 name=install
-baseurl=%s
-""" % url.getPlainURL())
-            username = url.getUsername()
-            if username is not None:
-                yum_conf.write("username=%s\n" % _quoteDnfString(username))
-            password = url.getPassword()
-            if password is not None:
-                yum_conf.write("password=%s\n" % _quoteDnfString(password))
+""")
+            yum_conf.write(_baseURLConfig(self))
             repo_config = self._repo_config()
             if repo_config is not None:
                 yum_conf.write(repo_config)
@@ -208,6 +285,7 @@ baseurl=%s
         self.disableInitrdCreation(mounts['root'])
         installFromYum(self._targets, mounts, progress_callback, self._cachedir)
         self.enableInitrdCreation()
+        discardPrefetched(self)
 
     def installPackages(self, progress_callback, mounts):
         self._accessor.start()
@@ -445,6 +523,50 @@ baseurl=%s
 
         return False
 
+class VerifiedPackageCache(object):
+    """ Records the sha256 of packages which have been verified, keyed by
+    the location of the package and a tag identifying its content (size and
+    mtime, or HTTP ETag), so that unchanged packages are not hashed again. """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.entries is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                self.entries = {}
+
+    def lookup(self, key, tag):
+        with self.lock:
+            self._load()
+            entry = self.entries.get(key)
+        if entry and entry['tag'] == tag:
+            return entry['sha256']
+        return None
+
+    def store(self, key, tag, sha256sum):
+        with self.lock:
+            self._load()
+            self.entries[key] = {'tag': tag, 'sha256': sha256sum}
+
+    def save(self):
+        with self.lock:
+            if self.entries is None:
+                return
+            try:
+                with open(self.path + '.new', 'w') as f:
+                    json.dump(self.entries, f)
+                os.rename(self.path + '.new', self.path)
+            except (IOError, OSError) as e:
+                logger.log("Failed to save verified package cache: %s" % e)
+
+verified_packages = VerifiedPackageCache(VERIFY_CACHE_FILE)
+
 class RPMPackage(object):
     def __init__(self, repository, name, size, sha256sum):
         self.repository = repository
@@ -452,32 +574,49 @@ class RPMPackage(object):
         self.size = int(size)
         self.sha256sum = sha256sum
 
-    def check(self, fast=False, progress=lambda x : ()):
+    def check(self, fast=False, progress=lambda x : (), force=False):
         """ Check a package against it's known checksum, or if fast is
-        specified, just check that the package exists. """
+        specified, just check that the package exists.  Unless force is
+        specified, a package verified before with the same content tag is
+        not hashed again. """
         if fast:
             return self.repository.accessor().access(self.name)
         else:
-            try:
-                logger.log("Validating package %s" % self.name)
-                namefp = self.repository.accessor().openAddress(self.name)
-                m = hashlib.sha256()
-                data = b''
-                total_read = 0
-                while True:
-                    data = namefp.read(10485760)
-                    total_read += len(data)
-                    if data == b'':
-                        break
-                    else:
-                        m.update(data)
-                    progress(total_read / (self.size / 100))
-                namefp.close()
-                calculated = m.hexdigest()
-                valid = (self.sha256sum == calculated)
-                return valid
-            except Exception as e:
-                return False
+            # the content tag and the content must come from the same mirror
+            for accessor in self.repository.accessor().sources():
+                try:
+                    return self._verify(accessor, progress, force)
+                except Exception as e:
+                    logger.log("Failed to validate package %s from %s: %s" % (self.name, accessor.url(), e))
+            return False
+
+    def _verify(self, accessor, progress, force):
+        key = accessor.cacheKey(self.name)
+        tag = accessor.contentTag(self.name)
+        if not force and tag is not None and verified_packages.lookup(key, tag) == self.sha256sum:
+            logger.log("Package %s already verified" % self.name)
+            progress(100)
+            return True
+
+        logger.log("Validating package %s" % self.name)
+        namefp = accessor.openAddress(self.name)
+        m = hashlib.sha256()
+        data = b''
+        total_read = 0
+        while True:
+            data = namefp.read(10485760)
+            total_read += len(data)
+            if data == b'':
+                break
+            else:
+                m.update(data)
+            progress(total_read / (self.size / 100))
+        namefp.close()
+        calculated = m.hexdigest()
+        valid = (self.sha256sum == calculated)
+        if valid and tag is not None:
+            verified_packages.store(key, tag, calculated)
+        return valid
 
 class Accessor:
     def pathjoin(base, name):
@@ -498,6 +637,30 @@ class Accessor:
     def canEject(self):
         return False
 
+    def cacheKey(self, name):
+        """ Return a string identifying 'name' in the verified package
+        cache. """
+        return self.pathjoin(str(self.url()), name)
+
+    def contentTag(self, name):
+        """ Return a string which changes when the content of 'name'
+        changes, or None if this cannot be determined cheaply. """
+        return None
+
+    def sources(self):
+        """ Return the accessors to try in turn for a series of reads which
+        must all be served from the same place. """
+        return [self]
+
+    def urls(self):
+        """ Return the URLs the repository can be read from, in order of
+        preference. """
+        return [self.url()]
+
+    def concurrentReads(self):
+        """ Return the number of files worth reading at once. """
+        return max(1, constants.VERIFY_WORKERS)
+
     def start(self):
         pass
 
@@ -527,6 +690,13 @@ class FilesystemAccessor(Accessor):
     def openAddress(self, addr):
         return open(os.path.join(self.location, addr), "rb")
 
+    def contentTag(self, name):
+        try:
+            st = os.stat(os.path.join(self.location, name))
+        except OSError:
+            return None
+        return "%d:%d" % (st.st_size, st.st_mtime_ns)
+
     def url(self):
         return util.URL("file://%s" % self.location)
 
@@ -569,6 +739,10 @@ class MountingAccessor(FilesystemAccessor):
             os.rmdir(self.location)
             self.location = None
 
+    def cacheKey(self, name):
+        # the mount point changes each time the media is mounted
+        return self.pathjoin(self.mount_source, name)
+
     def __del__(self):
         while self.start_count > 0:
             self.finish()
@@ -586,6 +760,10 @@ class DeviceAccessor(MountingAccessor):
     def canEject(self):
         return diskutil.removable(self.device)
 
+    def concurrentReads(self):
+        # concurrent reads make optical drives seek back and forth
+        return 1
+
     def eject(self):
         if self.canEject():
             self.finish()
@@ -638,6 +816,141 @@ class URLFileWrapper:
                 raise IOError('Seek beyond end of file')
 
 
+class HTTPConnectionPool:
+    """ Keeps idle persistent HTTP(S) connections, per scheme and host, so
+    that consecutive requests to a server reuse them. """
+    TIMEOUT = 60
+    MAX_IDLE = 8
+    MAX_REDIRECTS = 5
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def _connection(self, scheme, netloc):
+        with self.lock:
+            conns = self.idle.get((scheme, netloc))
+            if conns:
+                return conns.pop(), True
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.TIMEOUT), False
+        return http.client.HTTPConnection(netloc, timeout=self.TIMEOUT), False
+
+    def release(self, key, conn, response):
+        """ Return the connection used for response to the pool if it can
+        be reused, i.e. the body has been read in full. """
+        if response.isclosed() and not response.will_close:
+            with self.lock:
+                conns = self.idle.setdefault(key, [])
+                if len(conns) < self.MAX_IDLE:
+                    conns.append(conn)
+                    return
+        conn.close()
+
+    def request(self, method, url, headers):
+        """ Send a request, following redirects.  Returns the response and
+        the pool key and connection to release once it has been read. """
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            while True:
+                conn, reused = self._connection(*key)
+                try:
+                    conn.request(method, path, headers=headers)
+                    response = conn.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    # The server closed an idle connection: retry on a new one
+                    conn.close()
+                    if not reused:
+                        raise
+                except:
+                    conn.close()
+                    raise
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                self.release(key, conn, response)
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                if urllib.parse.urlsplit(url)[:2] != key:
+                    # don't send credentials to another server
+                    headers = dict((k, v) for k, v in headers.items() if k != 'Authorization')
+                continue
+            if response.status >= 400:
+                response.read()
+                self.release(key, conn, response)
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return response, key, conn
+        raise IOError("Too many redirects fetching %s" % url)
+
+http_pool = HTTPConnectionPool()
+
+class HTTPFileWrapper:
+    """ A file object reading a HTTP(S) resource over a pooled connection.
+    Seeks are implemented with Range requests. """
+    SEEK_SET = 0
+    SEEK_CUR = 1
+
+    def __init__(self, accessor, url, headers):
+        self.accessor = accessor
+        self.url = url
+        self.headers = headers
+        self.response = None
+        self._open(0)
+
+    def _open(self, offset):
+        headers = dict(self.headers)
+        if offset > 0:
+            headers['Range'] = 'bytes=%d-' % offset
+        self.response, self.key, self.conn = http_pool.request('GET', self.url, headers)
+        self.pos = 0
+        if offset > 0 and self.response.status != 206:
+            # Range not supported: skip forward in the full response
+            while self.pos < offset:
+                if not self.read(min(offset - self.pos, 1048576)):
+                    raise IOError('Seek beyond end of file')
+        self.pos = offset
+
+    def _release(self):
+        if self.response:
+            http_pool.release(self.key, self.conn, self.response)
+            self.response = None
+
+    def read(self, size=-1):
+        if self.response is None:
+            return b''
+        start = time.time()
+        if size is None or size < 0:
+            data = self.response.read()
+        else:
+            data = self.response.read(size)
+        self.accessor.recordTransfer(len(data), time.time() - start)
+        self.pos += len(data)
+        if self.response.isclosed():
+            self._release()
+        return data
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == self.SEEK_CUR:
+            offset += self.pos
+        elif whence != self.SEEK_SET:
+            raise Exception('Only SEEK_SET and SEEK_CUR supported')
+        if offset == self.pos:
+            return
+        self.close()
+        self._open(offset)
+
+    def close(self):
+        if self.response:
+            # A connection with unread data left in it cannot be reused
+            self.response.close()
+            self.conn.close()
+            self.response = None
+
 class URLAccessor(Accessor):
     def __init__(self, url):
         self._url = url
@@ -657,6 +970,17 @@ class URLAccessor(Accessor):
                 self.opener = urllib.request.build_opener(self.authhandler)
                 urllib.request.install_opener(self.opener)
 
+        # Use pooled connections unless a proxy has to be used
+        self._pooled = (self._url.getScheme() in ['http', 'https'] and
+                        self._url.getScheme() not in urllib.request.getproxies())
+        self._headers = {}
+        if self._pooled and self._url.getUsername() is not None:
+            credentials = '%s:%s' % (self._url.getUsername(), self._url.getPassword() or '')
+            self._headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+        self._transfer_lock = threading.Lock()
+        self._transferred = 0
+        self._transfer_time = 0.0
+
         logger.log("Initializing URLRepositoryAccessor with base address %s" % str(self._url))
 
     def _url_concat(url1, end):
@@ -682,9 +1006,63 @@ class URLAccessor(Accessor):
         pass
 
     def finish(self):
-        pass
+        with self._transfer_lock:
+            transferred, transfer_time = self._transferred, self._transfer_time
+            self._transferred = 0
+            self._transfer_time = 0.0
+        if transferred > 0:
+            logger.log("Transferred %d bytes from %s in %.1fs (%.1f MiB/s)" %
+                       (transferred, str(self._url), transfer_time,
+                        transferred / max(transfer_time, 0.001) / 2**20))
+
+    def recordTransfer(self, nbytes, seconds):
+        with self._transfer_lock:
+            self._transferred += nbytes
+            self._transfer_time += seconds
+
+    def throughput(self):
+        """ Return the average transfer rate in bytes per second since the
+        last call to finish(). """
+        with self._transfer_lock:
+            return self._transferred / max(self._transfer_time, 0.001)
+
+    def _head(self, path):
+        response, key, conn = http_pool.request('HEAD', self._url_concat(self._url.getPlainURL(), path), self._headers)
+        response.read()
+        http_pool.release(key, conn, response)
+        return response
+
+    def _firstByte(self, path):
+        headers = dict(self._headers)
+        headers['Range'] = 'bytes=0-0'
+        response, key, conn = http_pool.request('GET', self._url_concat(self._url.getPlainURL(), path), headers)
+        if response.status == 206:
+            response.read()
+            http_pool.release(key, conn, response)
+        else:
+            # the whole object is on its way: don't wait for it
+            response.close()
+            conn.close()
+        return response
 
     def access(self, path):
+        if self._pooled:
+            try:
+                self._head(path)
+            except urllib.error.HTTPError as e:
+                if e.code in (404, 410):
+                    return False
+            except Exception:
+                pass
+            else:
+                return True
+            # some servers and proxies reject or mishandle HEAD
+            try:
+                self._firstByte(path)
+            except Exception:
+                return False
+            return True
+
         if not self._url.getScheme == 'ftp':
             return Accessor.access(self, path)
 
@@ -713,15 +1091,159 @@ class URLAccessor(Accessor):
             return False
 
     def openAddress(self, address):
+        if self._pooled:
+            return HTTPFileWrapper(self, self._url_concat(self._url.getPlainURL(), address), self._headers)
         if self._url.getScheme() in ['http', 'https']:
             ret_val = urllib.request.urlopen(self._url_concat(self._url.getPlainURL(), address))
         else:
             ret_val = urllib.request.urlopen(self._url_concat(self._url.getURL(), address))
         return URLFileWrapper(ret_val)
 
+    def cacheKey(self, name):
+        return self._url_concat(self._url.getPlainURL(), name)
+
+    def contentTag(self, name):
+        if self._url.getScheme() not in ['http', 'https']:
+            return None
+        try:
+            if self._pooled:
+                response = self._head(name)
+                etag = response.getheader('ETag')
+                length = response.getheader('Content-Length')
+            else:
+                request = urllib.request.Request(self._url_concat(self._url.getPlainURL(), name), method='HEAD')
+                with urllib.request.urlopen(request) as response:
+                    etag = response.headers.get('ETag')
+                    length = response.headers.get('Content-Length')
+        except Exception:
+            return None
+        if not etag or etag.startswith('W/'):
+            return None
+        return "%s:%s" % (etag, length)
+
     def url(self):
         return self._url
 
+class MirrorAccessor(Accessor):
+    """ Accesses a repository available from several equivalent mirrors.
+    The mirrors are ranked by the time taken to fetch .treeinfo (or
+    repomd.xml for repositories without one);
+    reads are spread over the fastest mirrors and fail over to the others
+    when a mirror becomes unavailable. """
+    PROBE_FILENAMES = [".treeinfo", "repodata/repomd.xml"]
+    # mirrors no more than this many times slower than the fastest are used
+    STRIPE_FACTOR = 2
+
+    def __init__(self, accessors):
+        self.accessors = accessors
+        self.ranked = None
+        self.active = []
+        self.start_count = 0
+        self.next_mirror = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<MirrorAccessor: %s>" % ", ".join(map(repr, self.accessors))
+
+    def _name(self, accessor):
+        return str(getattr(accessor, 'mount_source', None) or accessor.url())
+
+    def _probe(self, accessor):
+        """ Return the time taken to fetch the probe file from accessor, or
+        None if it cannot be reached. """
+        start = time.time()
+        try:
+            accessor.start()
+        except Exception as e:
+            logger.log("Mirror %s unavailable: %s" % (self._name(accessor), e))
+            return None
+        for name in self.PROBE_FILENAMES:
+            try:
+                fp = accessor.openAddress(name)
+                try:
+                    fp.read()
+                finally:
+                    fp.close()
+                return time.time() - start
+            except Exception as e:
+                error = e
+        logger.log("Mirror %s unavailable: %s" % (self._name(accessor), error))
+        accessor.finish()
+        return None
+
+    def start(self):
+        with self.lock:
+            if self.start_count == 0:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.accessors)) as executor:
+                    timings = list(executor.map(self._probe, self.accessors))
+                ranked = sorted((t, i) for i, t in enumerate(timings) if t is not None)
+                if not ranked:
+                    raise NoRepository("No mirror is available")
+                for t, i in ranked:
+                    logger.log("Mirror %s: %.3fs" % (self._name(self.accessors[i]), t))
+                self.ranked = [self.accessors[i] for t, i in ranked]
+                self.active = [self.accessors[i] for t, i in ranked if t <= ranked[0][0] * self.STRIPE_FACTOR]
+            self.start_count += 1
+
+    def finish(self):
+        with self.lock:
+            if self.start_count == 0:
+                return
+            self.start_count -= 1
+            if self.start_count == 0:
+                for accessor in self.ranked:
+                    accessor.finish()
+                self.ranked = None
+                self.active = []
+
+    def _mirrors(self):
+        """ Return the mirrors to try in turn, starting with the next of
+        the active mirrors. """
+        with self.lock:
+            if self.ranked is None:
+                return list(self.accessors)
+            active = self.active or self.ranked
+            first = active[self.next_mirror % len(active)]
+            self.next_mirror += 1
+            return [first] + [a for a in self.ranked if a is not first]
+
+    def _failed(self, accessor, name, e):
+        logger.log("Mirror %s failed fetching %s: %s" % (self._name(accessor), name, e))
+        with self.lock:
+            if accessor in self.active and len(self.active) > 1:
+                self.active.remove(accessor)
+
+    def openAddress(self, address):
+        error = None
+        for accessor in self._mirrors():
+            try:
+                return accessor.openAddress(address)
+            except Exception as e:
+                self._failed(accessor, address, e)
+                error = e
+        raise error
+
+    def access(self, name):
+        return any(accessor.access(name) for accessor in self._mirrors())
+
+    def cacheKey(self, name):
+        return "mirrors:" + ";".join(accessor.cacheKey(name) for accessor in self.accessors)
+
+    def contentTag(self, name):
+        return self._mirrors()[0].contentTag(name)
+
+    def sources(self):
+        return self._mirrors()
+
+    def url(self):
+        """ The URL of the fastest mirror. """
+        return self.urls()[0]
+
+    def urls(self):
+        with self.lock:
+            mirrors = self.ranked or self.accessors
+        return [accessor.url() for accessor in mirrors]
+
 def repositoriesFromDefinition(media, address, drivers=False):
     if media == 'local':
         # this is a special case as we need to locate the media first
@@ -730,7 +1252,9 @@ def repositoriesFromDefinition(media, address, drivers=False):
         accessors = { 'filesystem': FilesystemAccessor,
                       'url': URLAccessor,
                       'nfs': NFSAccessor }
-        if media in accessors:
+        if media == 'mirrors':
+            accessor = MirrorAccessor([accessors[m](a) for m, a in address])
+        elif media in accessors:
             accessor = accessors[media](address)
         else:
             raise RuntimeError("Unknown repository media %s" % media)
@@ -871,18 +1395,11 @@ def installFromRepos(progress_callback, repos, mounts):
         with open('/root/yum.conf', 'w') as yum_conf:
             yum_conf.write(_generateYumConf(cachedir))
             for repo in repos:
-                url = repo._accessor.url()
                 yum_conf.write("""
 [%s]
 name=%s
-baseurl=%s
-""" % (repo.identifier(), repo.identifier(), url.getPlainURL()))
-                username = url.getUsername()
-                if username is not None:
-                    yum_conf.write("username=%s\n" % _quoteDnfString(username))
-                password = url.getPassword()
-                if password is not None:
-                    yum_conf.write("password=%s\n" % _quoteDnfString(password))
+""" % (repo.identifier(), repo.identifier()))
+                yum_conf.write(_baseURLConfig(repo))
                 repo_config = repo._repo_config()
                 if repo_config is not None:
                     yum_conf.write(repo_config)
@@ -900,3 +1417,249 @@ baseurl=%s
     finally:
         for repo in repos:
             repo._accessor.finish()
+            discardPrefetched(repo)
+
+def neededPackages(repos):
+    """ Returns the set of the packages of repos which installing their
+    targets might need: the packages, or members of the groups, named as
+    targets and, recursively, every package providing something they
+    require.  This is a superset of what dnf will resolve since versions
+    are not compared. """
+    providers = {}
+    for repo in repos:
+        for pkg in repo:
+            for capability in pkg.provides:
+                providers.setdefault(capability, []).append(pkg)
+
+    todo = []
+    for repo in repos:
+        for target in repo._targets or []:
+            group = repo.groupPackages(target.lstrip('@'))
+            if target.startswith('@') or (target not in providers and group is not None):
+                if group is None:
+                    raise RepoFormatError("Group %s not found in %s" % (target, repo.name()))
+                todo += group
+            else:
+                todo.append(target)
+
+    needed = set()
+    while todo:
+        for pkg in providers.get(todo.pop(), []):
+            if pkg not in needed:
+                needed.add(pkg)
+                todo += pkg.requires
+    return needed
+
+class PrefetchStopped(Exception):
+    pass
+
+class PackagePrefetcher(object):
+    """ Copies the repodata, and the packages needed to install the
+    targets, of remote repositories into a local directory in the
+    background, verifying each package against its checksum before making
+    it visible, so that dnf can install from local storage.  dnf falls back
+    to the original location of a repository for packages which are not
+    there.  Prefetching a repository stops when its installation starts. """
+
+    def __init__(self, sources, location):
+        self.sources = sources
+        self.location = location
+        self.mirrors = {}
+        self.stopped = set()
+        self.current = None
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        repos = []
+        for media, address in self.sources:
+            if media not in ['url', 'nfs', 'mirrors']:
+                continue
+            try:
+                for repo in repositoriesFromDefinition(media, address):
+                    if hasattr(repo, '_packages'):
+                        repos.append(repo)
+                    else:
+                        logger.log("Not prefetching %s: no package list" % repo.name())
+            except Exception as e:
+                logger.log("Prefetch from %s failed: %s" % (str(address), e))
+        try:
+            for repo in repos:
+                repo.accessor().start()
+            try:
+                needed = neededPackages(repos)
+            finally:
+                for repo in repos:
+                    repo.accessor().finish()
+        except Exception as e:
+            logger.log("Not prefetching: failed to resolve the packages to install: %s" % e)
+            return
+        for repo in repos:
+            self._prefetch(repo, [p for p in repo if p in needed])
+
+    def _copy(self, accessor, name, dest, key, sha256sum=None):
+        path = os.path.join(dest, name)
+        util.assertDir(os.path.dirname(path))
+        m = hashlib.sha256()
+        infh = accessor.openAddress(name)
+        try:
+            with open(path + '.part', 'wb') as outfh:
+                while True:
+                    if key in self.stopped:
+                        raise PrefetchStopped()
+                    data = infh.read(1048576)
+                    if not data:
+                        break
+                    m.update(data)
+                    outfh.write(data)
+            if sha256sum is not None and m.hexdigest() != sha256sum:
+                raise IOError("Checksum mismatch for %s" % name)
+        except:
+            if os.path.exists(path + '.part'):
+                os.unlink(path + '.part')
+            raise
+        finally:
+            infh.close()
+        # only complete, verified, files are visible to dnf
+        os.rename(path + '.part', path)
+
+    def _copyPackage(self, accessor, pkg, dest, key):
+        if key in self.stopped:
+            return False
+        try:
+            self._copy(accessor, pkg.name, dest, key, pkg.sha256sum)
+        except PrefetchStopped:
+            return False
+        except Exception as e:
+            logger.log("Prefetch of %s failed: %s" % (pkg.name, e))
+            return False
+        return True
+
+    def _prefetch(self, repo, packages):
+        accessor = repo.accessor()
+        key = accessor.cacheKey('')
+        with self.lock:
+            if key in self.stopped:
+                return
+            self.current = key
+        try:
+            self._prefetchPackages(repo, accessor, key, packages)
+        finally:
+            with self.lock:
+                self.current = None
+                self.idle.notify_all()
+
+    def _prefetchPackages(self, repo, accessor, key, packages):
+        dest = os.path.join(self.location, hashlib.sha256(key.encode()).hexdigest()[:16])
+        util.assertDir(dest)
+
+        total_size = sum(p.size for p in packages)
+        st = os.statvfs(dest)
+        if total_size > st.f_bavail * st.f_frsize // 2:
+            logger.log("Not prefetching %s: %d bytes needed, insufficient space in %s" %
+                       (repo.name(), total_size, self.location))
+            return
+
+        start = time.time()
+        accessor.start()
+        try:
+            try:
+                repomdfp = accessor.openAddress(YumRepository.REPOMD_FILENAME)
+                repomd_xml = parse(repomdfp)
+                repomdfp.close()
+                self._copy(accessor, YumRepository.REPOMD_FILENAME, dest, key)
+                for location in repomd_xml.getElementsByTagName("location"):
+                    self._copy(accessor, location.getAttribute("href"), dest, key)
+            except Exception as e:
+                logger.log("Prefetch of %s failed: %s" % (repo.name(), e))
+                shutil.rmtree(dest, ignore_errors=True)
+                return
+
+            # dnf can use the packages as soon as they arrive
+            with self.lock:
+                self.mirrors[key] = dest
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, constants.VERIFY_WORKERS)) as executor:
+                done = list(executor.map(lambda p: self._copyPackage(accessor, p, dest, key), packages))
+        finally:
+            accessor.finish()
+
+        logger.log("Prefetched %d of the %d packages of %s needed (%d bytes) in %.1fs" %
+                   (done.count(True), len(packages), repo.name(),
+                    sum(p.size for p, ok in zip(packages, done) if ok), time.time() - start))
+
+    def stop(self, repo):
+        """ Stop prefetching repo, waiting for the copies in progress to
+        be abandoned. """
+        key = repo.accessor().cacheKey('')
+        with self.lock:
+            self.stopped.add(key)
+            while self.current == key:
+                self.idle.wait()
+
+    def localURL(self, repo):
+        self.stop(repo)
+        with self.lock:
+            dest = self.mirrors.get(repo.accessor().cacheKey(''))
+        if dest:
+            return util.URL("file://%s" % dest)
+        return None
+
+    def discard(self, repo):
+        self.stop(repo)
+        with self.lock:
+            dest = self.mirrors.pop(repo.accessor().cacheKey(''), None)
+        if dest:
+            shutil.rmtree(dest, ignore_errors=True)
+
+prefetcher = None
+
+def startPrefetch(sources):
+    """ Start copying the packages of the remote repositories in sources,
+    a list of (media, address) pairs, to local storage. """
+    global prefetcher
+    prefetcher = PackagePrefetcher(sources, PREFETCH_DIR)
+    prefetcher.start()
+
+def installURLs(repo):
+    """ Return the URLs dnf should install the packages of repo from, in
+    order of preference. """
+    urls = repo.accessor().urls()
+    if prefetcher:
+        url = prefetcher.localURL(repo)
+        if url:
+            logger.log("Installing %s from prefetched packages" % repo.name())
+            urls.insert(0, url)
+    return urls
+
+def _baseURLConfig(repo):
+    """ Return the baseurl, and any credentials, of repo for a dnf
+    configuration.  dnf sends the same credentials to every URL, so mirrors
+    needing others than the preferred remote URL are left out. """
+    urls = installURLs(repo)
+    remote = [url for url in urls if url.getScheme() != 'file']
+    credentials = (remote[0].getUsername(), remote[0].getPassword()) if remote else (None, None)
+    baseurls = []
+    for url in urls:
+        if url.getScheme() == 'file' or (url.getUsername(), url.getPassword()) == credentials:
+            baseurls.append(url)
+        else:
+            logger.log("Not installing from %s: its credentials differ from those of %s" % (url, remote[0]))
+    logger.log("URL: " + " ".join(map(str, baseurls)))
+    config = "baseurl=%s\n" % " ".join(url.getPlainURL() for url in baseurls)
+    username, password = credentials
+    if username is not None:
+        config += "username=%s\n" % _quoteDnfString(username)
+    if password is not None:
+        config += "password=%s\n" % _quoteDnfString(password)
+    return config
+
+def discardPrefetched(repo):
+    if prefetcher:
+        prefetcher.discard(repo)
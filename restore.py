@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: GPL-2.0-only
 
 import backend
+import copyutil
 import product
 from disktools import *
 import diskutil
@@ -99,17 +100,22 @@ def restoreFromBackup(backup, progress=lambda x: ()):
             efi_mounted = True
 
             # copy files from the backup partition to the restore partition:
-            objs = [x for x in os.listdir(backup_fs.mount_point) if x not in ['lost+found', '.xen-backup-partition', '.xen-gpt.bin']]
-            for i in range(len(objs)):
-                obj = objs[i]
-                logger.log("Restoring subtree %s..." % obj)
-                progress((i * 100) / len(objs))
-
-                # Use 'cp' here because Python's copying tools are useless and
-                # get stuck in an infinite loop when copying e.g. /dev/null.
-                if util.runCmd2(['cp', '-a', os.path.join(backup_fs.mount_point, obj),
-                                 dest_fs.mount_point]) != 0:
-                    raise RuntimeError("Failed to restore %s directory" % obj)
+            copier = copyutil.TreeCopier(backup_fs.mount_point, dest_fs.mount_point,
+                                         exclude=constants.BACKUP_METADATA)
+            copier.scan()
+            copier.copy(lambda done, total: progress((done * 100) // max(total, 1)))
+
+            manifest = copyutil.readManifest(os.path.join(backup_fs.mount_point, constants.BACKUP_MANIFEST))
+            if manifest is None:
+                logger.log("Backup has no manifest, not verifying the restored files")
+            else:
+                problems = copyutil.verifyManifest(dest_fs.mount_point, manifest)
+                if problems:
+                    for problem in problems:
+                        logger.log("Restore verification: %s" % problem)
+                    raise RuntimeError("Restored files do not match the backup: %s" %
+                                       ", ".join(problems[:5]))
+                logger.log("Verified %d restored files against the backup manifest" % len(manifest))
 
             logger.log("Data restoration complete.  About to re-install bootloader.")
 
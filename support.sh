@@ -2,7 +2,7 @@
 
 # SPDX-License-Identifier: GPL-2.0-only
 
-SUPPORT_FILE="/tmp/support.tar.bz2"
+SUPPORT_FILE="/tmp/support.tar.gz"
 echo "Collecting logs for submission to Technical Support..."
 /usr/bin/python3 /opt/xensource/installer/xelogging.py
 echo
@@ -12,5 +12,5 @@ ls -la ${SUPPORT_FILE}
 echo
 echo "The contents of ${SUPPORT_FILE}:"
 echo
-tar jtvf ${SUPPORT_FILE}
+tar ztvf ${SUPPORT_FILE}
 
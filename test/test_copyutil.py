@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import errno
+import os.path
+import shutil
+import tempfile
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..'))
+
+import unittest
+from unittest import mock
+import copyutil
+
+class TreeTestCase(unittest.TestCase):
+    """ A tree with a hard link, a symbolic link and a sparse file """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        os.makedirs(os.path.join(self.src, 'etc', 'sub'))
+        os.makedirs(os.path.join(self.src, 'proc', 'self'))
+        os.mkdir(self.dst)
+        with open(os.path.join(self.src, 'etc', 'data'), 'wb') as f:
+            f.write(os.urandom(3 * copyutil.CHUNK_SIZE // 2))
+        with open(os.path.join(self.src, 'etc', 'sparse'), 'wb') as f:
+            f.seek(64 * 2**20)
+            f.write(b'end')
+        with open(os.path.join(self.src, 'skipped'), 'w') as f:
+            f.write('skipped')
+        os.link(os.path.join(self.src, 'etc', 'data'), os.path.join(self.src, 'etc', 'sub', 'link'))
+        os.symlink('../data', os.path.join(self.src, 'etc', 'sub', 'symlink'))
+        os.chmod(os.path.join(self.src, 'etc', 'data'), 0o4750)
+        os.utime(os.path.join(self.src, 'etc', 'sub'), (1000000000, 1000000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def copy(self, **kwargs):
+        copier = copyutil.TreeCopier(self.src, self.dst, **kwargs)
+        copier.scan()
+        calls = []
+        copier.copy(lambda done, total: calls.append((done, total)))
+        return copier, calls
+
+    def read(self, root, path):
+        with open(os.path.join(root, path), 'rb') as f:
+            return f.read()
+
+class TestTreeCopier(TreeTestCase):
+    def test_copy(self):
+        copier, calls = self.copy(exclude=['skipped'], skip_contents=['proc'])
+
+        self.assertEqual(calls[-1], (copier.total_bytes, copier.total_bytes))
+        for path in ('etc/data', 'etc/sparse'):
+            self.assertEqual(self.read(self.src, path), self.read(self.dst, path))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'skipped')))
+        self.assertEqual(os.listdir(os.path.join(self.dst, 'proc')), [])
+
+        data = os.stat(os.path.join(self.dst, 'etc', 'data'))
+        self.assertEqual(data.st_mode & 0o7777, 0o4750)
+        self.assertEqual(data.st_nlink, 2)
+        self.assertEqual(os.readlink(os.path.join(self.dst, 'etc', 'sub', 'symlink')), '../data')
+        self.assertEqual(os.stat(os.path.join(self.dst, 'etc', 'sub')).st_mtime, 1000000000)
+
+        sparse = os.stat(os.path.join(self.dst, 'etc', 'sparse'))
+        self.assertLess(sparse.st_blocks * 512, sparse.st_size)
+
+    def test_fallbacks(self):
+        with mock.patch.object(copyutil, '_use_copy_file_range', False), \
+             mock.patch.object(copyutil, '_use_sendfile', False):
+            self.copy()
+        self.assertEqual(self.read(self.src, 'etc/data'), self.read(self.dst, 'etc/data'))
+
+    def test_failure(self):
+        def fail(src, dst, st, account, remap=None, digest=None):
+            raise IOError("disk full")
+        with mock.patch.object(copyutil, 'copyFile', side_effect=fail):
+            self.assertRaises(RuntimeError, self.copy)
+
+class TestCopyPath(TreeTestCase):
+    def test_remap(self):
+        seen = []
+        def remap(st):
+            seen.append(st.st_mode)
+            # keep the ownership so that this doesn't need to run as root
+            return os.getuid(), os.getgid(), (st.st_mode & ~0o7777) | 0o640
+        dst = os.path.join(self.dst, 'etc')
+        n = copyutil.copyPath(os.path.join(self.src, 'etc'), dst, remap)
+
+        # etc, etc/sub, data, sparse, link and symlink
+        self.assertEqual(n, 6)
+        # the hard link shares the metadata of data
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(self.read(self.src, 'etc/data'), self.read(self.dst, 'etc/data'))
+        for path in ('', 'sub', 'data', 'sparse'):
+            self.assertEqual(os.stat(os.path.join(dst, path)).st_mode & 0o7777, 0o640)
+        self.assertEqual(os.stat(os.path.join(dst, 'data')).st_nlink, 2)
+
+        copyutil.copyPath(os.path.join(self.src, 'skipped'), os.path.join(self.dst, 'file'), remap)
+        self.assertEqual(os.stat(os.path.join(self.dst, 'file')).st_mode & 0o7777, 0o640)
+
+class TestManifest(TreeTestCase):
+    def test_verify(self):
+        manifest = copyutil.buildManifest(self.src, exclude=['skipped'])
+        filename = os.path.join(self.tmp, 'manifest')
+        copyutil.writeManifest(filename, manifest)
+        self.assertEqual(copyutil.readManifest(filename), manifest)
+        self.assertIsNone(copyutil.readManifest(os.path.join(self.tmp, 'missing')))
+
+        self.copy(exclude=['skipped'])
+        self.assertEqual(copyutil.verifyManifest(self.dst, manifest), [])
+
+        os.unlink(os.path.join(self.dst, 'etc', 'sub', 'symlink'))
+        os.truncate(os.path.join(self.dst, 'etc', 'sparse'), 10)
+        with open(os.path.join(self.dst, 'etc', 'data'), 'r+b') as f:
+            f.write(b'corrupt')
+        problems = copyutil.verifyManifest(self.dst, manifest)
+        self.assertEqual(len(problems), 4)
+        self.assertEqual(problems[0], '/etc/data: checksum differs')
+        self.assertTrue(problems[1].startswith('/etc/sparse'))
+
+    def test_incremental(self):
+        copier, _ = self.copy(checksum=True)
+        manifest = copyutil.buildManifest(self.dst, known=copier.entries())
+        for path in ('etc/data', 'etc/sparse'):
+            self.assertEqual(manifest[path]['sha256'], copyutil.fileChecksum(os.path.join(self.src, path)))
+        self.assertEqual(manifest['etc/sub/link'], manifest['etc/data'])
+
+        with open(os.path.join(self.src, 'etc', 'new'), 'w') as f:
+            f.write('new')
+        os.unlink(os.path.join(self.src, 'skipped'))
+        os.unlink(os.path.join(self.src, 'etc', 'sub', 'link'))
+        with open(os.path.join(self.src, 'etc', 'sub', 'link'), 'w') as f:
+            f.write('no longer a link')
+
+        copied = []
+        real_copy = copyutil.copyFile
+        def copy_file(src, dst, st, account, remap=None, digest=None):
+            copied.append(os.path.relpath(src, self.src))
+            real_copy(src, dst, st, account, remap, digest)
+        with mock.patch.object(copyutil, 'copyFile', side_effect=copy_file):
+            copier, _ = self.copy(previous=manifest, checksum=True)
+
+        # removing the link changed the link count, and so ctime, of data
+        self.assertEqual(sorted(copied), ['etc/data', 'etc/new', 'etc/sub/link'])
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'skipped')))
+        self.assertEqual(self.read(self.dst, 'etc/data'), self.read(self.src, 'etc/data'))
+        self.assertEqual(os.stat(os.path.join(self.dst, 'etc', 'data')).st_nlink, 1)
+        self.assertEqual(copyutil.verifyManifest(self.dst, copyutil.buildManifest(self.src)), [])
+
+        # a change of metadata alone, keeping the mtime
+        manifest = copyutil.buildManifest(self.dst, known=copier.entries())
+        os.chmod(os.path.join(self.src, 'etc', 'sparse'), 0o644)
+        del copied[:]
+        with mock.patch.object(copyutil, 'copyFile', side_effect=copy_file):
+            self.copy(previous=manifest, checksum=True)
+        self.assertEqual(copied, ['etc/sparse'])
+
+class TestAllocateFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'swap')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def check(self, size):
+        st = os.stat(self.filename)
+        self.assertEqual(st.st_size, size)
+        self.assertGreaterEqual(st.st_blocks * 512, size)
+        self.assertEqual(st.st_mode & 0o777, 0o600)
+
+    def test_allocate(self):
+        copyutil.allocateFile(self.filename, 16 * 2**20)
+        self.check(16 * 2**20)
+
+    def test_fallback(self):
+        with open(self.filename, 'wb') as f:
+            f.seek(2**20)
+            f.write(b'old')
+        os.chmod(self.filename, 0o600)
+        with mock.patch.object(os, 'posix_fallocate', side_effect=OSError(errno.EOPNOTSUPP, 'unsupported')):
+            copyutil.allocateFile(self.filename, copyutil.CHUNK_SIZE + 4096)
+        self.check(copyutil.CHUNK_SIZE + 4096)
+        self.assertEqual(open(self.filename, 'rb').read(), bytes(copyutil.CHUNK_SIZE + 4096))
+
+if __name__ == '__main__':
+    unittest.main()
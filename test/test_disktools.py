@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import os.path
+import json
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..'))
+
+import unittest
+from unittest import mock
+from disktools import FreePool, LVMTool, MoveChunk, Segment
+
+EXTENT = 4 * 2**20
+
+def synthetic_report(pv_name, extents, used):
+    """ An 'lvm fullreport' for a single PV of 'extents' extents, with LV
+    segments at the (start, size) ranges listed in 'used'. """
+    return json.dumps({'report': [{
+        'vg': [{'vg_name': 'VG_XenStorage-test', 'vg_extent_size': str(EXTENT)}],
+        # pv_size includes some padding after the last extent
+        'pv': [{'pv_name': pv_name, 'vg_name': 'VG_XenStorage-test',
+                'pe_start': str(2**20), 'pv_size': str(extents * EXTENT + 3 * 2**20),
+                'pv_free': str((extents - sum(size for _, size in used)) * EXTENT),
+                'pv_pe_count': str(extents), 'dev_size': str(extents * EXTENT + 2**20)}],
+        'lv': [{'lv_name': 'lv%d' % i, 'vg_name': 'VG_XenStorage-test'} for i in range(len(used))],
+        'seg': [{'seg_pe_ranges': LVMTool.encodeSegmentRange(pv_name, start, size)} for start, size in used],
+        }]})
+
+def fragmented(extents, fragments):
+    """ Used ranges of one extent every other extent, spread over the PV """
+    step = extents // fragments
+    return [(i * step, 1) for i in range(fragments)]
+
+def make_tool(pv_name, extents, used):
+    with mock.patch.object(LVMTool, 'cmdWrap', return_value=synthetic_report(pv_name, extents, used)):
+        return LVMTool()
+
+class TestFreePool(unittest.TestCase):
+    def test_take_across_segments(self):
+        pool = FreePool([Segment(0, 2), Segment(5, 3), Segment(10, 4)])
+        taken = pool.takeSegments(4)
+        self.assertEqual([(s.start, s.size) for s in taken], [(0, 2), (5, 2)])
+        taken = pool.takeSegments(3)
+        self.assertEqual([(s.start, s.size) for s in taken], [(7, 1), (10, 2)])
+        self.assertEqual(pool.freeSpace(), 2)
+
+    def test_out_of_space(self):
+        pool = FreePool([Segment(0, 2)])
+        self.assertRaises(Exception, pool.takeSegments, 3)
+
+class TestLVMTool(unittest.TestCase):
+    def setUp(self):
+        fd, self.pv = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.pv)
+
+    def test_device_to_pv(self):
+        tool = make_tool(self.pv, 100, [(0, 10)])
+        link = self.pv + '-link'
+        os.symlink(self.pv, link)
+        try:
+            self.assertEqual(tool.deviceToPV(link)['pv_name'], self.pv)
+        finally:
+            os.unlink(link)
+        self.assertIsNone(tool.deviceToPVOrNone(__file__))
+
+    def test_segments(self):
+        tool = make_tool(self.pv, 100, [(50, 10), (0, 10), (70, 5)])
+        self.assertEqual([(s.start, s.size) for s in tool.segmentList(self.pv)],
+                         [(0, 10), (50, 10), (70, 5)])
+        self.assertEqual([(s.start, s.size) for s in tool.freeSegmentList(self.pv)],
+                         [(10, 40), (60, 10), (75, 25)])
+        self.assertEqual([(s.start, s.size) for s in tool.segmentsToMove(self.pv, 55)],
+                         [(55, 5), (70, 5)])
+
+    def test_extent_size(self):
+        tool = make_tool(self.pv, 100, [(0, 10)])
+        self.assertEqual(tool.extentBytes(self.pv), EXTENT)
+
+    def test_make_space(self):
+        tool = make_tool(self.pv, 100, [(0, 10), (50, 10), (70, 5)])
+        tool.makeSpaceAfterThreshold(self.pv, 55)
+        self.assertEqual([(m.src, m.dest, m.size) for m in tool.moveLists[self.pv]],
+                         [(55, 10, 5), (70, 15, 5)])
+
+    def test_make_space_fragmented(self):
+        extents, fragments = 200000, 20000
+        tool = make_tool(self.pv, extents, fragmented(extents, fragments))
+        tool.makeSpaceAfterThreshold(self.pv, extents // 2)
+        moves = tool.moveLists[self.pv]
+        self.assertEqual(sum(m.size for m in moves), fragments // 2)
+        self.assertTrue(all(m.dest + m.size <= extents // 2 for m in moves))
+
+class TestMoves(unittest.TestCase):
+    def test_coalesce(self):
+        moves = [MoveChunk(20, 2, 2), MoveChunk(10, 0, 2), MoveChunk(12, 5, 3), MoveChunk(15, 8, 1)]
+        self.assertEqual([(m.src, m.dest, m.size) for m in LVMTool.coalesceMoves(moves)],
+                         [(10, 0, 2), (12, 5, 4), (20, 2, 2)])
+
+    def test_execute_moves(self):
+        moves = [MoveChunk(1000 + i * 2, i, 1) for i in range(100)] + [MoveChunk(5000, 200, 5000)]
+        calls = []
+        progress = []
+        with mock.patch.object(LVMTool, 'runPvmove', side_effect=lambda cb, params: (calls.append(params), cb(50))):
+            LVMTool.executeMoves(progress.append, '/dev/sda3', moves, EXTENT)
+        # at most 64 ranges and 4096 extents per pvmove
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[0][2], '/dev/sda3:' + ':'.join('%d-%d' % (1000 + i * 2, 1000 + i * 2) for i in range(64)))
+        self.assertTrue(calls[1][2].endswith(':1198-1198:5000-9059'))
+        self.assertEqual(calls[2][2:], ['/dev/sda3:9060-9999', '/dev/sda3:4260-5199'])
+        self.assertEqual(progress, sorted(progress))
+        self.assertLess(progress[-1], 100)
+
+def bench():
+    """ Time makeSpaceAfterThreshold on increasingly fragmented PVs: the
+    time per fragment should stay roughly constant. """
+    fd, pv = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for fragments in (2500, 5000, 10000, 20000, 40000):
+            extents = fragments * 10
+            start = time.time()
+            tool = make_tool(pv, extents, fragmented(extents, fragments))
+            tool.deviceToPV(pv)
+            tool.makeSpaceAfterThreshold(pv, extents // 2)
+            elapsed = time.time() - start
+            print("%6d fragments: %.3fs (%.1fus per fragment)" % (fragments, elapsed, elapsed * 1e6 / fragments))
+    finally:
+        os.unlink(pv)
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        bench()
+    else:
+        unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import os.path
+import re
+import json
+import hashlib
+import shutil
+import tempfile
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..'))
+
+import unittest
+from unittest import mock
+import constants
+import copyutil
+import upgrade
+
+class RestoreUpgrader(upgrade.Upgrader):
+    def buildRestoreList(self, src_base):
+        return ['etc/owned', 'etc/stranger', 'etc/missing',
+                {'dir': 'etc/conf', 're': re.compile(r'.*\.conf$'),
+                 'attr': {'user': 'root', 'group': 'root', 'mode': 0o600}}]
+
+class TestCompleteUpgrade(unittest.TestCase):
+    """ Restore files from a backup whose users have different ids to those
+    of the new root """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.backup = os.path.join(self.tmp, 'backup')
+        self.root = os.path.join(self.tmp, 'root')
+        uid, gid = os.getuid(), os.getgid()
+        self.write(self.backup, 'etc/passwd', 'root:x:0:0::/root:/bin/sh\nuser:x:%d:%d::/:/bin/sh\n' % (uid, gid))
+        self.write(self.backup, 'etc/group', 'root:x:0:\nuser:x:%d:\n' % gid)
+        self.write(self.root, 'etc/passwd', 'root:x:0:0::/root:/bin/sh\nuser:x:4242:4242::/:/bin/sh\n')
+        self.write(self.root, 'etc/group', 'root:x:0:\nuser:x:4343:\n')
+        self.write(self.backup, 'etc/owned', 'owned')
+        self.write(self.backup, 'etc/stranger', 'stranger')
+        self.write(self.backup, 'etc/conf/a.conf', 'a')
+        self.write(self.backup, 'etc/conf/b.txt', 'b')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, root, path, data):
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def test_restore(self):
+        owners = {}
+        real_copy = copyutil.copyPath
+        def copy_path(src, dst, remap):
+            path = os.path.relpath(dst, self.root)
+            def record(st):
+                if path == 'etc/stranger':
+                    # owned by a user missing from the backup's passwd
+                    st = mock.Mock(st_uid=12345, st_gid=st.st_gid, st_mode=st.st_mode)
+                uid, gid, mode = remap(st)
+                owners[path] = (uid, gid)
+                # keep the ownership so that this doesn't need to run as root
+                return os.getuid(), os.getgid(), mode
+            return real_copy(src, dst, record)
+
+        mount = mock.Mock(mount_point=self.backup)
+        with mock.patch.object(upgrade.util, 'TempMount', return_value=mount), \
+             mock.patch.object(upgrade, 'partitionDevice'), \
+             mock.patch.object(copyutil, 'copyPath', side_effect=copy_path):
+            RestoreUpgrader(None).completeUpgrade({'root': self.root}, '/dev/sda', 2)
+
+        mount.unmount.assert_called_once_with()
+        self.assertEqual(owners['etc/owned'], (4242, 4343))
+        self.assertEqual(owners['etc/stranger'], (12345, os.getgid()))
+        self.assertEqual(owners['etc/conf/a.conf'], (0, 0))
+        self.assertNotIn('etc/conf/b.txt', owners)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'etc/missing')))
+        with open(os.path.join(self.root, 'etc/owned')) as f:
+            self.assertEqual(f.read(), 'owned')
+        self.assertEqual(os.stat(os.path.join(self.root, 'etc/conf/a.conf')).st_mode & 0o7777, 0o600)
+
+class TestDoBackup(unittest.TestCase):
+    """ Back up a root filesystem to an empty backup partition """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.mounts = {'/dev/sda1': os.path.join(self.tmp, 'root'),
+                       '/dev/sda2': os.path.join(self.tmp, 'backup')}
+        for d in self.mounts.values():
+            os.makedirs(d)
+        os.makedirs(os.path.join(self.tmp, 'root', 'etc'))
+        with open(os.path.join(self.tmp, 'root', 'etc', 'data'), 'wb') as f:
+            f.write(b'data' * 100000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_backup(self):
+        upgrader = upgrade.ThirdGenUpgrader.__new__(upgrade.ThirdGenUpgrader)
+        upgrader.source = mock.Mock(root_device='/dev/sda1')
+        upgrader.safe2upgrade = False
+        tool = mock.Mock(partTableType=constants.PARTITION_GPT)
+
+        with mock.patch.object(upgrade, 'PartitionTool', return_value=tool), \
+             mock.patch.object(upgrade, 'partitionDevice', side_effect=lambda disk, num: '%s%d' % (disk, num)), \
+             mock.patch.object(upgrade.diskutil, 'fs_type_from_device', return_value='ext4'), \
+             mock.patch.object(upgrade.util, 'mkfs'), \
+             mock.patch.object(upgrade.util, 'runCmd2', return_value=(0, '')), \
+             mock.patch.object(upgrade.util, 'TempMount',
+                               side_effect=lambda dev, *args, **kwargs: mock.Mock(mount_point=self.mounts[dev])), \
+             mock.patch.object(copyutil, '_use_copy_file_range', True), \
+             mock.patch.object(copyutil.os, 'copy_file_range', wraps=os.copy_file_range) as copy_file_range:
+            upgrader.doBackup(lambda x: (), '/dev/sda', 2, 0, 0, 5)
+
+        # the data was copied in the kernel, and checksummed all the same
+        self.assertTrue(copy_file_range.called)
+        with open(os.path.join(self.mounts['/dev/sda2'], constants.BACKUP_MANIFEST)) as f:
+            entries = json.load(f)['entries']
+        self.assertEqual(entries['etc/data']['sha256'], hashlib.sha256(b'data' * 100000).hexdigest())
+
+if __name__ == '__main__':
+    unittest.main()
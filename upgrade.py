@@ -3,7 +3,10 @@
 import os
 import re
 import shutil
+import collections
+import threading
 
+import copyutil
 import diskutil
 import product
 from xcp.version import *
@@ -80,97 +83,78 @@ class Upgrader(object):
         src_gid_map = {}
         dst_gid_map = {}
 
-        def init_id_maps(src_root, dst_root):
-            """ Create mappings between (username and uid), and (group and
-            gid) for the source and destination roots. """
-            with open(os.path.join(src_root, 'etc/passwd'), 'r') as f:
-                for line in f:
-                    try:
-                        pwnam, _, uid, _ = line.split(':', 3)
-                        src_uid_map[int(uid)] = pwnam
-                    except ValueError as e:
-                        logger.error('Failed to parse: ' + line)
-                        logger.logException(e)
-
-            with open(os.path.join(src_root, 'etc/group'), 'r') as f:
-                for line in f:
-                    try:
-                        pwnam, _, gid, _ = line.split(':', 3)
-                        src_gid_map[int(gid)] = pwnam
-                    except ValueError as e:
-                        logger.error('Failed to parse: ' + line)
-                        logger.logException(e)
-
-            with open(os.path.join(dst_root, 'etc/passwd'), 'r') as f:
-                for line in f:
-                    try:
-                        pwnam, _, uid, _ = line.split(':', 3)
-                        dst_uid_map[pwnam] = int(uid)
-                    except ValueError as e:
-                        logger.error('Failed to parse: ' + line)
-                        logger.logException(e)
-
-            with open(os.path.join(dst_root, 'etc/group'), 'r') as f:
+        def read_id_map(filename, id_map, by_name):
+            """ Fill id_map from an /etc/passwd or /etc/group format file,
+            mapping name to id if by_name, id to name otherwise. """
+            with open(filename, 'r') as f:
                 for line in f:
                     try:
-                        pwnam, _, gid, _ = line.split(':', 3)
-                        dst_gid_map[pwnam] = int(gid)
+                        name, _, id, _ = line.split(':', 3)
+                        if by_name:
+                            id_map[name] = int(id)
+                        else:
+                            id_map[int(id)] = name
                     except ValueError as e:
                         logger.error('Failed to parse: ' + line)
                         logger.logException(e)
 
-        # Copy attributes from a path in a source root to another path in a
-        # destination root. 
-        # - The ownership is copied such that it is notaffected by changes 
+        def init_id_maps(src_root, dst_root):
+            """ Create mappings between (username and uid), and (group and
+            gid) for the source and destination roots. """
+            read_id_map(os.path.join(src_root, 'etc/passwd'), src_uid_map, False)
+            read_id_map(os.path.join(src_root, 'etc/group'), src_gid_map, False)
+            read_id_map(os.path.join(dst_root, 'etc/passwd'), dst_uid_map, True)
+            read_id_map(os.path.join(dst_root, 'etc/group'), dst_gid_map, True)
+
+        # Returns a function giving the ownership and mode of the copy of a
+        # file in the destination root, for copyutil.
+        # - The ownership is copied such that it is not affected by changes
         #   in the underlying uid/gid. Or it's set to the specified.
         # - The mode is set to the specified.
-        def copy_attributes(src_root, src_path, dst_root, dst_path, attr=None):
-            dst_f = '%s/%s' % (dst_root, dst_path)
-
-            st = os.lstat('%s/%s' % (src_root, src_path))
-            try:
-                user = src_uid_map[st.st_uid]
-                group = src_gid_map[st.st_gid]
-                if attr is not None:
-                    user = attr.get('user', user)
-                    group = attr.get('group', group)
-                new_uid = dst_uid_map[user]
-                new_gid = dst_gid_map[group]
-            except IndexError as e:
-                logger.error('Failed to determine ownership')
-                logger.logException(e)
-                return
-            if st.st_uid != new_uid or st.st_gid != new_gid:
-                logger.log("Update uid=%d gid=%d" % (new_uid, new_gid))
-                os.lchown(dst_f, new_uid, new_gid)
-
-            if attr is not None and 'mode' in attr:
-                mode = (st.st_mode & ~0o7777) | attr['mode']
-                logger.log("Update mode=0o%o" % mode)
-                os.chmod(dst_f, mode)
+        def remap_attributes(attr, counts):
+            lock = threading.Lock()
+            def count(key):
+                with lock:
+                    counts[key] += 1
+
+            def remap(st):
+                try:
+                    user = src_uid_map[st.st_uid]
+                    group = src_gid_map[st.st_gid]
+                    if attr is not None:
+                        user = attr.get('user', user)
+                        group = attr.get('group', group)
+                    new_uid = dst_uid_map[user]
+                    new_gid = dst_gid_map[group]
+                except KeyError:
+                    count('unknown')
+                    return st.st_uid, st.st_gid, st.st_mode
+                if st.st_uid != new_uid or st.st_gid != new_gid:
+                    count('owner')
+                mode = st.st_mode
+                if attr is not None and 'mode' in attr:
+                    mode = (st.st_mode & ~0o7777) | attr['mode']
+                return new_uid, new_gid, mode
+            return remap
 
         def restore_file(src_base, f, d=None, attr=None):
             if not d: d = f
             src = os.path.join(src_base, f)
             dst = os.path.join(mounts['root'], d)
             if os.path.lexists(src):
-                logger.log("Restoring /%s" % f)
                 util.assertDir(os.path.dirname(dst))
-                # copy file/folder and try to preserve all attributes
-                if os.path.isdir(src):
-                    util.runCmd2(['cp', '-a', src, os.path.dirname(dst)])
-                else:
-                    util.runCmd2(['cp', '-a', src, dst])
-
-                # copy or set mode and ownership attributes
-                abs_f = os.path.join('/', f)
-                abs_d = os.path.join('/', d)
-                copy_attributes(src_base, abs_f, mounts['root'], abs_d, attr)
-                for dirpath, dirnames, filenames in os.walk(src):
-                    for i in dirnames + filenames:
-                        src_path = os.path.join(dirpath, i)[len(src_base):]
-                        dst_path = os.path.join(abs_d, src_path[len(abs_f) + 1:])
-                        copy_attributes(src_base, src_path, mounts['root'], dst_path, attr)
+                # copy file/folder, preserving all attributes but mapping
+                # the ownership to the destination's users and groups
+                counts = collections.Counter()
+                try:
+                    n = copyutil.copyPath(src, dst, remap_attributes(attr, counts))
+                except Exception as e:
+                    logger.error("Failed to restore /%s" % f)
+                    logger.logException(e)
+                    return
+                logger.log("Restored /%s: %d entries, %d with new ownership%s" %
+                           (f, n, counts['owner'],
+                            counts['unknown'] and ", %d with unknown owner kept" % counts['unknown'] or ""))
             else:
                 logger.log("WARNING: /%s did not exist in the backup image." % f)
 
@@ -315,6 +299,7 @@ class ThirdGenUpgrader(Upgrader):
         self.testUpgradeForbidden(tool)
 
         # Check if possible to create new partition layout, increasing the size, using plugin result
+        repartitioned = False
         if self.safe2upgrade and logs_partition is None: 
             if storage_partnum > 0:
                 # Get current Volume Group
@@ -337,42 +322,46 @@ class ThirdGenUpgrader(Upgrader):
             tool.resizePartition(number=backup_partnum, sizeBytes=constants.backup_size * 2**20)
             # Write partition table
             tool.commit(log=True)
+            repartitioned = True
 
-        # format the backup partition:
+        # format the backup partition, unless it holds a complete backup of
+        # the same root filesystem which can be brought up to date:
         backupfs_type = diskutil.fs_type_from_device(self.source.root_device)
         backup_partition = partitionDevice(target_disk, backup_partnum)
-        try:
-            util.mkfs(backupfs_type, backup_partition)
-        except Exception as e:
-            raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (backup_partition, e))
+        previous = None
+        if constants.INCREMENTAL_BACKUP and not repartitioned:
+            previous = self.previousBackup(backup_partition, backupfs_type)
+        if previous is None:
+            try:
+                util.mkfs(backupfs_type, backup_partition)
+            except Exception as e:
+                raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (backup_partition, e))
+        else:
+            logger.log("Updating the existing backup on %s incrementally" % backup_partition)
         progress_callback(10)
 
         # copy the files across:
         primary_fs = util.TempMount(self.source.root_device, 'primary-', options=['ro'], boot_device=boot_device)
         try:
             backup_fs = util.TempMount(backup_partition, 'backup-')
+            complete = False
             try:
+                if previous is not None:
+                    # the backup is incomplete until the manifest is rewritten
+                    for f in ['.xen-backup-partition', constants.BACKUP_MANIFEST]:
+                        os.unlink(os.path.join(backup_fs.mount_point, f))
                 just_dirs = ['dev', 'proc', 'lost+found', 'sys']
-                top_dirs = os.listdir(primary_fs.mount_point)
-                val = 10
-                for x in top_dirs:
-                    if x in just_dirs:
-                        path = os.path.join(backup_fs.mount_point, x)
-                        if not os.path.exists(path):
-                            os.mkdir(path, 0o755)
-                    else:
-                        cmd = ['cp', '-a'] + \
-                              [ os.path.join(primary_fs.mount_point, x) ] + \
-                              ['%s/' % backup_fs.mount_point]
-                        if util.runCmd2(cmd) != 0:
-                            raise RuntimeError("Backup of %s directory failed" % x)
-                    val += 90 / len(top_dirs)
-                    progress_callback(val)
+                copier = copyutil.TreeCopier(primary_fs.mount_point, backup_fs.mount_point,
+                                             skip_contents=just_dirs, previous=previous,
+                                             checksum=True)
+                copier.scan()
+                copier.copy(lambda done, total: progress_callback(10 + (90 * done) // max(total, 1)))
 
                 # save the GPT table
                 rc, err = util.runCmd2(["sgdisk", "-b", os.path.join(backup_fs.mount_point, '.xen-gpt.bin'), target_disk], with_stderr=True)
                 if rc != 0:
                     raise RuntimeError("Failed to save partition layout: %s" % err)
+                complete = True
             finally:
                 # replace rolling pool upgrade bootloader config
                 def replace_config(config_file, destination):
@@ -387,12 +376,44 @@ class ThirdGenUpgrader(Upgrader):
                 for config_file, destination in configMaps:
                     replace_config(config_file, destination)
 
+                # record what a restore of the backup must reproduce
+                if complete:
+                    manifest = copyutil.buildManifest(backup_fs.mount_point, constants.BACKUP_METADATA,
+                                                      copier.entries())
+                    copyutil.writeManifest(os.path.join(backup_fs.mount_point, constants.BACKUP_MANIFEST),
+                                           manifest, self.rootFilesystemUUID())
+
                 fh = open(os.path.join(backup_fs.mount_point, '.xen-backup-partition'), 'w')
                 fh.close()
                 backup_fs.unmount()
         finally:
             primary_fs.unmount()
 
+    def rootFilesystemUUID(self):
+        rc, out = util.runCmd2(['blkid', '-o', 'value', '-s', 'UUID', self.source.root_device], with_stdout=True)
+        return out.strip() if rc == 0 and out.strip() else None
+
+    def previousBackup(self, backup_partition, backupfs_type):
+        """ Returns the manifest of a complete backup of the root filesystem
+        being upgraded on backup_partition, or None. """
+        source = self.rootFilesystemUUID()
+        if not source:
+            return None
+        try:
+            if diskutil.fs_type_from_device(backup_partition) != backupfs_type:
+                return None
+            backup_fs = util.TempMount(backup_partition, 'backup-', options=['ro'])
+        except Exception as e:
+            logger.log("No previous backup on %s: %s" % (backup_partition, e))
+            return None
+        try:
+            if not os.path.exists(os.path.join(backup_fs.mount_point, '.xen-backup-partition')):
+                return None
+            return copyutil.readManifest(os.path.join(backup_fs.mount_point, constants.BACKUP_MANIFEST),
+                                         source)
+        finally:
+            backup_fs.unmount()
+
     prepUpgradeArgs = []
     prepStateChanges = ['installation-uuid', 'control-domain-uuid']
     def prepareUpgrade(self, progress_callback):
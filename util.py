@@ -3,7 +3,11 @@
 import os
 import os.path
 import subprocess
-import urllib.request, urllib.parse
+import urllib.request, urllib.parse, urllib.error
+import http.client
+import socket
+import hashlib
+import json
 import shutil
 import re
 import datetime
@@ -12,6 +16,7 @@ import random
 import string
 import tempfile
 import errno
+import constants
 from version import *
 from xcp import logger
 
@@ -222,14 +227,126 @@ class TempMount:
 class InvalidSource(Exception):
     pass
 
+class FetchError(Exception):
+    pass
+
+# network errors other than ConnectionError and timeouts which can clear
+_TRANSIENT_ERRNOS = (errno.ENETDOWN, errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ETIMEDOUT)
+
+def _fetchRetryable(e):
+    """ Whether a failed fetch is worth retrying: server and network errors
+    are, unlike errors writing the destination (e.g. ENOSPC). """
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code >= 500 or e.code in (408, 429)
+    if isinstance(e, urllib.error.URLError):
+        e = e.reason
+    if isinstance(e, socket.gaierror):
+        return e.errno == socket.EAI_AGAIN
+    if isinstance(e, (socket.timeout, ConnectionError, http.client.HTTPException, FetchError)):
+        return True
+    return isinstance(e, OSError) and e.errno in _TRANSIENT_ERRNOS
+
+def _fetchHTTP(url, dest, cache, timeout):
+    """ Download url to dest, resuming from the partial download left in
+    cache by a failed attempt and revalidating a complete cached copy. """
+    opener = urllib.request.build_opener()
+    if url.getUsername():
+        passman = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+        passman.add_password(None, url.getBaseURL(), url.getUsername(), url.getPassword())
+        opener = urllib.request.build_opener(urllib.request.HTTPBasicAuthHandler(passman))
+
+    meta = {}
+    if os.path.exists(cache + '.json'):
+        with open(cache + '.json', 'r') as f:
+            meta = json.load(f)
+    validator = meta.get('etag') or meta.get('last-modified')
+
+    request = urllib.request.Request(url.getPlainURL())
+    offset = 0
+    if meta.get('complete') and os.path.exists(cache):
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last-modified'):
+            request.add_header('If-Modified-Since', meta['last-modified'])
+    elif validator and os.path.exists(cache):
+        offset = os.path.getsize(cache)
+        request.add_header('Range', 'bytes=%d-' % offset)
+        request.add_header('If-Range', validator)
+
+    try:
+        resp = opener.open(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            logger.log("Using cached copy of %s" % url)
+            shutil.copyfile(cache, dest)
+            return
+        if e.code == 416 and offset > 0:
+            # the partial download is longer than the object: start again
+            logger.log("Discarding partial download of %s" % url)
+            e.close()
+            for path in (cache, cache + '.json'):
+                os.unlink(path)
+            return _fetchHTTP(url, dest, cache, timeout)
+        raise
+
+    with resp:
+        if resp.status == 206:
+            logger.log("Resuming download of %s at %d bytes" % (url, offset))
+            mode = 'ab'
+        else:
+            mode = 'wb'
+        meta = {'etag': resp.headers.get('ETag'),
+                'last-modified': resp.headers.get('Last-Modified'),
+                'complete': False}
+        with open(cache + '.json', 'w') as f:
+            json.dump(meta, f)
+        with open(cache, mode) as fd_cache:
+            shutil.copyfileobj(resp, fd_cache)
+        length = resp.headers.get('Content-Length')
+        if length is not None and os.path.getsize(cache) != int(length) + (offset if mode == 'ab' else 0):
+            raise FetchError("Short read fetching %s" % url)
+
+    meta['complete'] = True
+    with open(cache + '.json', 'w') as f:
+        json.dump(meta, f)
+    shutil.copyfile(cache, dest)
+
+def _fetchCachePath(url):
+    return os.path.join(constants.FETCH_CACHE_DIR, hashlib.sha256(url.getPlainURL().encode()).hexdigest())
+
+def _fetchURL(source, dest, timeout):
+    url = URL(source)
+    if url.getScheme() in ['http', 'https']:
+        assertDir(constants.FETCH_CACHE_DIR)
+        _fetchHTTP(url, dest, _fetchCachePath(url), timeout)
+    else:
+        with urllib.request.urlopen(source, timeout=timeout) as fd_resp, open(dest, 'wb') as fd_dest:
+            shutil.copyfileobj(fd_resp, fd_dest)
+
+def _verifyFile(path, sha256sum):
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1048576), b''):
+            m.update(data)
+    return m.hexdigest() == sha256sum.lower()
+
 # source may be
 #  http://blah
 #  ftp://blah
 #  file://blah
 #  nfs://server:/path/blah
-def fetchFile(source, dest):
+# optionally followed by #sha256=<hex digest> to verify the file fetched.
+# HTTP(S) downloads are cached and revalidated using ETag or Last-Modified,
+# and failed transfers are retried with backoff, resuming where possible.
+def fetchFile(source, dest, sha256sum=None):
     cleanup_dirs = []
 
+    m = re.match(r'(.*)#sha256=([0-9a-fA-F]{64})$', source)
+    if m:
+        source = m.group(1)
+        if sha256sum is None:
+            sha256sum = m.group(2)
+
     try:
         # if it's NFS, then mount the NFS server then treat like
         # file://:
@@ -256,18 +373,27 @@ def fetchFile(source, dest):
                source[:5] == 'file:' or \
                source[:4] == 'ftp:':
             # This something that can be fetched using urllib
-            request = source
-
-            url = URL(source)
-            if url.getScheme() in ['http', 'https'] and url.getUsername(): # Auth HTTP(s)
-                passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                passman.add_password(None, url.getBaseURL(), url.getUsername(), url.getPassword())
-                handler = urllib2.HTTPBasicAuthHandler(passman)
-                urllib2.install_opener(urllib2.build_opener(handler))
-                request = url.getPlainURL()
-
-            with urllib.request.urlopen(request) as fd_resp, open(dest, 'wb') as fd_dest:
-                shutil.copyfileobj(fd_resp, fd_dest)
+            attempt = 0
+            while True:
+                try:
+                    _fetchURL(source, dest, constants.FETCH_TIMEOUT)
+                    if sha256sum and not _verifyFile(dest, sha256sum):
+                        raise FetchError("Checksum mismatch fetching %s" % URL(source))
+                    break
+                except Exception as e:
+                    url = URL(source)
+                    if isinstance(e, FetchError) and url.getScheme() in ['http', 'https']:
+                        # don't resume from, or reuse, corrupt data
+                        cache = _fetchCachePath(url)
+                        for path in (cache, cache + '.json'):
+                            if os.path.exists(path):
+                                os.unlink(path)
+                    attempt += 1
+                    if attempt >= constants.FETCH_ATTEMPTS or url.getScheme() == 'file' or not _fetchRetryable(e):
+                        raise
+                    delay = min(2 ** attempt, 30) * random.uniform(0.5, 1.5)
+                    logger.log("Fetching %s failed (%s), retrying in %.1fs" % (url, e, delay))
+                    time.sleep(delay)
         else:
             raise InvalidSource("Unknown source type.")
 
@@ -3,48 +3,149 @@
 # SPDX-License-Identifier: GPL-2.0-only
 
 import os
+import io
+import json
+import time
 import shutil
+import tarfile
+import subprocess
+import concurrent.futures
 import sys
 import fcntl
 import datetime
 import traceback
 import constants
+from xcp import logger
 
 
-def collectLogs(dst, tarball_dir=None):
-    """ Make a support tarball including all logs (and some more) from 'dst'."""
-    os.system("cat /proc/bus/pci/devices >%s/pci-log 2>&1" % dst)
-    os.system("lspci -i /usr/share/misc/pci.ids -vv >%s/lspci-log 2>&1" % dst)
-    os.system("lspci -n >%s/lspcin-log 2>&1" % dst)
-    os.system("cat /proc/modules >%s/modules-log 2>&1" % dst)
-    os.system("cat /proc/interrupts >%s/interrupts-log 2>&1" % dst)
-    os.system("uname -a >%s/uname-log 2>&1" % dst)
-    os.system("ls /sys/block >%s/blockdevs-log 2>&1" % dst)
-    os.system("ls -lR /dev >%s/devcontents-log 2>&1" % dst)
-    os.system("tty >%s/tty-log 2>&1" % dst)
-    os.system("cat /proc/cmdline >%s/cmdline-log 2>&1" % dst)
-    os.system("dmesg >%s/dmesg-log 2>&1" % dst)
-    os.system("xl dmesg >%s/xl-dmesg-log 2>&1" % dst)
-    os.system("ps axf >%s/processes-log 2>&1" % dst)
-    os.system("vgscan -P >%s/vgscan-log 2>&1" % dst)
-    os.system("cat /var/log/multipathd >%s/multipathd-log 2>&1" % dst)
-    os.system("rpm -qa >%s/rpm-qa-log 2>&1" % dst)
+# Commands whose output is collected in the support tarball, and the name
+# of the file each is written to
+PROBES = [
+    ('pci-log', ['cat', '/proc/bus/pci/devices']),
+    ('lspci-log', ['lspci', '-i', '/usr/share/misc/pci.ids', '-vv']),
+    ('lspcin-log', ['lspci', '-n']),
+    ('modules-log', ['cat', '/proc/modules']),
+    ('interrupts-log', ['cat', '/proc/interrupts']),
+    ('uname-log', ['uname', '-a']),
+    ('blockdevs-log', ['ls', '/sys/block']),
+    ('devcontents-log', ['ls', '-lR', '/dev']),
+    ('tty-log', ['tty']),
+    ('cmdline-log', ['cat', '/proc/cmdline']),
+    ('dmesg-log', ['dmesg']),
+    ('xl-dmesg-log', ['xl', 'dmesg']),
+    ('processes-log', ['ps', 'axf']),
+    ('vgscan-log', ['vgscan', '-P']),
+    ('multipathd-log', ['cat', '/var/log/multipathd']),
+    ('rpm-qa-log', ['rpm', '-qa']),
+    ]
+
+# Probes which report on the console, so inherit the installer's stdin
+CONSOLE_PROBES = ['tty-log']
+
+def runProbe(name, cmd):
+    """ Run cmd, returning its combined stdout and stderr and a manifest
+    entry recording how long it took and how it exited. """
+    start = time.time()
+    entry = {'name': name, 'command': ' '.join(cmd), 'timed_out': False}
+    try:
+        stdin = None if name in CONSOLE_PROBES else subprocess.DEVNULL
+        proc = subprocess.run(cmd, stdin=stdin, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, timeout=constants.LOG_PROBE_TIMEOUT)
+        output = proc.stdout
+        entry['exit_code'] = proc.returncode
+    except subprocess.TimeoutExpired as e:
+        output = e.output or b''
+        entry['exit_code'] = None
+        entry['timed_out'] = True
+    except OSError as e:
+        output = ("%s: %s\n" % (cmd[0], e.strerror)).encode()
+        entry['exit_code'] = 127
+    entry['duration'] = round(time.time() - start, 3)
+    return output, entry
 
+def addData(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+def collectLogs(dst, tarball_dir=None):
+    """ Make a support tarball including all logs (and some more) from 'dst'.
+    The probes run concurrently and their output is written to 'dst' and
+    straight into the tarball as each completes.  Failures are logged and
+    skipped: this never raises. """
     if not tarball_dir:
         tarball_dir = dst
 
     if dst != '/tmp':
-        if os.path.exists("/tmp/install-log"):
-            shutil.copy("/tmp/install-log", dst)
+        for f in ["/tmp/install-log", constants.TIMELINE_FILE]:
+            if os.path.exists(f):
+                try:
+                    shutil.copy(f, dst)
+                except Exception as e:
+                    logger.log("Failed to copy %s to %s: %s" % (f, dst, e))
         if os.path.exists(constants.SCRIPTS_DIR):
             os.system("cp -r "+constants.SCRIPTS_DIR+" %s/" % dst)
-    logs = [x for x in os.listdir(dst) if x.endswith('-log') or x == 'answerfile' or
-                  x.startswith(os.path.basename(constants.SCRIPTS_DIR))]
-    logs = " ".join(logs)
+    names = set(name for name, _ in PROBES)
+    try:
+        logs = [x for x in os.listdir(dst) if (x.endswith('-log') and x not in names) or x == 'answerfile' or
+                      x == os.path.basename(constants.TIMELINE_FILE) or
+                      x.startswith(os.path.basename(constants.SCRIPTS_DIR))]
+    except Exception as e:
+        logger.log("Failed to list the logs in %s: %s" % (dst, e))
+        logs = []
 
+    tar = None
     if os.path.exists(tarball_dir):
-        # tar up contents
-        os.system("tar -C %s -cjf %s/support.tar.bz2 %s" % (dst, tarball_dir, logs))
+        try:
+            tar = tarfile.open(os.path.join(tarball_dir, constants.SUPPORT_TARBALL), 'w:gz', compresslevel=6)
+        except Exception as e:
+            logger.log("Failed to create the support tarball in %s: %s" % (tarball_dir, e))
+
+    def add(name, data=None):
+        if tar:
+            try:
+                if data is None:
+                    tar.add(os.path.join(dst, name), name)
+                else:
+                    addData(tar, name, data)
+            except Exception as e:
+                logger.log("Failed to add %s to the support tarball: %s" % (name, e))
+
+    def write(name, data):
+        try:
+            with open(os.path.join(dst, name), 'wb') as f:
+                f.write(data)
+        except Exception as e:
+            logger.log("Failed to write %s to %s: %s" % (name, dst, e))
+
+    manifest = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(PROBES)) as executor:
+        futures = dict((executor.submit(runProbe, name, cmd), name) for name, cmd in PROBES)
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                output, entry = future.result()
+            except Exception as e:
+                logger.log("Failed to collect %s: %s" % (futures[future], e))
+                continue
+            manifest.append(entry)
+            write(entry['name'], output)
+            add(entry['name'], output)
+
+    order = [name for name, _ in PROBES]
+    manifest.sort(key=lambda e: order.index(e['name']))
+    data = json.dumps(manifest, indent=2).encode() + b'\n'
+    write(constants.LOG_PROBES_MANIFEST, data)
+    add(constants.LOG_PROBES_MANIFEST, data)
+    for x in logs:
+        add(x)
+
+    if tar:
+        try:
+            tar.close()
+        except Exception as e:
+            logger.log("Failed to write the support tarball: %s" % e)
 
 def main():
     collectLogs("/tmp")